@@ -0,0 +1,103 @@
+import time
+import resource
+import multiprocessing
+from argparse import ArgumentParser
+
+
+def peak_memory_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_context_query_attention(args, memory_efficient):
+    import numpy as np
+    import tensorflow as tf
+    from layers import ContextQueryAttention
+
+    c = tf.placeholder(tf.float32, [None, args.cont_limit, args.hidden])
+    q = tf.placeholder(tf.float32, [None, args.ques_limit, args.hidden])
+    c_len = tf.placeholder(tf.int32, [None, 1])
+    q_len = tf.placeholder(tf.int32, [None, 1])
+    layer = ContextQueryAttention(args.cont_limit, args.ques_limit, 'glorot_uniform', None,
+                                  0., memory_efficient=memory_efficient)
+    x, S_q, S_c = layer([c, q, c_len, q_len])
+    feed_dict = {
+        c: np.random.randn(args.batch, args.cont_limit, args.hidden).astype(np.float32),
+        q: np.random.randn(args.batch, args.ques_limit, args.hidden).astype(np.float32),
+        c_len: np.full((args.batch, 1), args.cont_limit, dtype=np.int32),
+        q_len: np.full((args.batch, 1), args.ques_limit, dtype=np.int32)}
+    return x, feed_dict
+
+
+def build_self_attention(args, fused):
+    # one pass through the attention sublayers of the output encoder
+    import numpy as np
+    import tensorflow as tf
+    from layers import MultiHeadAttention, attention_mask
+
+    x = tf.placeholder(tf.float32, [None, args.cont_limit, args.hidden])
+    seq_len = tf.placeholder(tf.int32, [None, 1])
+    feed_dict = {
+        x: np.random.randn(args.batch, args.cont_limit, args.hidden).astype(np.float32),
+        seq_len: np.full((args.batch, 1), args.cont_limit, dtype=np.int32)}
+    if fused:
+        mask = list(attention_mask(seq_len, tf.shape(x)[1]))
+    outputs = x
+    for _ in range(args.num_blocks):
+        layer = MultiHeadAttention(args.hidden, args.num_heads, 'glorot_uniform', None, 0.)
+        if fused:
+            outputs = layer([outputs, outputs, outputs] + mask)
+        else:
+            # distinct tensors force separate Q/K/V projections and a mask per call
+            outputs = layer([outputs, tf.identity(outputs), tf.identity(outputs), seq_len])
+    return outputs, feed_dict
+
+
+LAYERS = {
+    'cqa-tiled': lambda args: build_context_query_attention(args, False),
+    'cqa-efficient': lambda args: build_context_query_attention(args, True),
+    'mha-separate': lambda args: build_self_attention(args, False),
+    'mha-fused': lambda args: build_self_attention(args, True),
+}
+
+
+def run(name, args, queue):
+    import tensorflow as tf
+    from keras import backend as K
+
+    output, feed_dict = LAYERS[name](args)
+    sess = K.get_session()
+    sess.run(tf.global_variables_initializer())
+    baseline = peak_memory_mb()
+    sess.run(output, feed_dict)  # warm up
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        sess.run(output, feed_dict)
+    latency = (time.perf_counter() - start) / args.repeat * 1000
+    queue.put((latency, peak_memory_mb() - baseline))
+
+
+def main(args):
+    # every layer runs in a fresh process so that peak memory is not shared
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    for name in args.layers:
+        process = context.Process(target=run, args=(name, args, queue))
+        process.start()
+        latency, memory = queue.get()
+        process.join()
+        print(f'{name}: {latency:.1f} ms/call, peak memory +{memory:.0f} MB')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--layers', nargs='+', choices=list(LAYERS), default=list(LAYERS))
+    parser.add_argument('--batch', default=32, type=int)
+    parser.add_argument('--hidden', default=96, type=int)
+    parser.add_argument('--cont-limit', default=400, type=int)
+    parser.add_argument('--ques-limit', default=50, type=int)
+    parser.add_argument('--num-heads', default=1, type=int)
+    parser.add_argument('--num-blocks', default=7, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    args = parser.parse_args()
+    main(args)
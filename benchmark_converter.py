@@ -0,0 +1,82 @@
+import os
+import time
+import shutil
+from tempfile import TemporaryDirectory
+from argparse import ArgumentParser
+
+import numpy as np
+
+from data import SquadReader, SquadConverter, SquadDepConverter
+
+from prepare_vocab import PAD_TOKEN, UNK_TOKEN
+
+
+def measure(func, repeat):
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def padded_process_text(converter, texts, max_length):
+    # the string padding + dict.get implementation _process_text replaced
+    texts = [[converter._lower(token.text) for token in text] for text in texts]
+    length = max(len(text) for text in texts)
+    if length > max_length:
+        texts = [text[:max_length] for text in texts]
+    texts = [x + [converter._pad_token] * (max_length - len(x)) for x in texts]
+    return np.array([
+        [converter._token_to_index.get(token, converter._unk_index) for token in text]
+        for text in texts], dtype=np.int32)
+
+
+def main(args):
+    # read a temporary copy, so that the offsets index is not written next to the fixture
+    with TemporaryDirectory() as dirname:
+        data_path = os.path.join(dirname, os.path.basename(args.data_path))
+        shutil.copyfile(args.data_path, data_path)
+        dataset = SquadReader(data_path)
+        rows = dataset[0:len(dataset)]
+    texts = [row[0] for row in rows] + [row[1] for row in rows]
+    token_to_index = {PAD_TOKEN: 0, UNK_TOKEN: 1}
+
+    converter = SquadConverter(token_to_index, PAD_TOKEN, UNK_TOKEN,
+                               pipe_batch_size=args.pipe_batch_size, n_process=args.n_process)
+    dep_converter = SquadDepConverter(token_to_index, PAD_TOKEN, UNK_TOKEN,
+                                      pipe_batch_size=args.pipe_batch_size, n_process=args.n_process)
+    benchmarks = [
+        ('tokenizer', lambda: [converter._tokenizer(x) for x in texts],
+         lambda: converter._batch_tokenizer(texts)),
+        ('parser', lambda: [dep_converter._token_and_dep(x) for x in texts],
+         lambda: dep_converter._batch_token_and_dep(texts))]
+
+    print(f'{len(texts)} sentences from {args.data_path}')
+    for name, per_string, batched in benchmarks:
+        before = len(texts) / measure(per_string, args.repeat)
+        after = len(texts) / measure(batched, args.repeat)
+        print(f'{name}: per-string {before:.1f} sentences/s, '
+              f'nlp.pipe {after:.1f} sentences/s ({after / before:.2f}x)')
+
+    # index encoding of one batch of contexts, tokenized up front
+    contexts = [rows[i % len(rows)][0] for i in range(args.batch)]
+    docs = converter._batch_tokenizer(contexts)
+    vocab = {token.text.lower() for doc in docs for token in doc}
+    token_to_index.update((token, i + 2) for i, token in enumerate(vocab))
+    before = measure(lambda: padded_process_text(converter, docs, args.context_max_len), args.repeat)
+    after = measure(lambda: converter._process_text(docs, args.context_max_len), args.repeat)
+    print(f'_process_text: padded lists {before * 1000:.3f} ms/batch, '
+          f'preallocated {after * 1000:.3f} ms/batch ({before / after:.2f}x) '
+          f'for {args.batch} contexts')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--data-path', default='./tests/fixtures/squad.tsv', type=str)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--pipe-batch-size', default=256, type=int)
+    parser.add_argument('--n-process', default=1, type=int)
+    parser.add_argument('--batch', default=32, type=int)
+    parser.add_argument('--context-max-len', default=400, type=int)
+    args = parser.parse_args()
+    main(args)
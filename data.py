@@ -1,20 +1,27 @@
-import pickle
+import io
+import os
 import csv
+import json
 import math
-import linecache
-from collections import Counter
+import mmap
+import pickle
+import bisect
+import multiprocessing
+from collections import Counter, deque
+from collections.abc import Mapping, Sequence
 from itertools import takewhile
 
 import numpy as np
 import spacy
 
-from utils import get_spans
+from utils import get_spans, load_line_offsets, imap_ordered, iter_chunks
 from dependency_labels import LABELS
 
 
 def make_vocab(tokens, min_count, max_vocab_size,
                speicial_tokens=('<pad>', '<unk>', '<s>', '</s>')):
-    counter = Counter(tokens)
+    # tokens: an iterable of tokens or an already merged Counter
+    counter = tokens if isinstance(tokens, Counter) else Counter(tokens)
     ordered_tokens, _ = zip(*takewhile(lambda x: x[1] >= min_count,
                                        counter.most_common()))
     if speicial_tokens is not None:
@@ -30,16 +37,145 @@ def make_vocab(tokens, min_count, max_vocab_size,
 
 
 def load_squad_tokens(filename, tokenizer, indices=[0, 1]):
+    # streams one field after the other, so the token order matches a full load
+    for i in indices:
+        with open(filename) as f:
+            for row in csv.reader(f, delimiter='\t'):
+                yield from tokenizer(row[i])
+
+
+_count_tokenizer = None
+
+
+def _init_count_worker(tokenizer):
+    global _count_tokenizer
+    _count_tokenizer = tokenizer
+
+
+def _count_chunk(chunk):
+    return [Counter(token for text in texts for token in _count_tokenizer(text))
+            for texts in zip(*chunk)]
+
+
+def count_squad_tokens(filename, tokenizer, indices=(0, 1), chunk_size=1000, num_workers=1):
+    # one pass over the file, returns a Counter per field in indices
+    counters = [Counter() for _ in indices]
     with open(filename) as f:
-        data = [row for row in csv.reader(f, delimiter='\t')]
-    data = [[tokenizer(x[i]) for i in indices] for x in data]
-    results = list(zip(*data))
-    if len(results) == 1:
-        sequence = results[0]
-    elif len(results) == 2:
-        sequence = results[0] + results[1]
-    tokens = (token for tokens in sequence for token in tokens)
-    return tokens
+        rows = ([row[i] for i in indices] for row in csv.reader(f, delimiter='\t'))
+        chunks = iter_chunks(rows, chunk_size)
+        # merged in file order, so most_common breaks ties as a full load would
+        for _, partial in imap_ordered(_count_chunk, chunks, num_workers,
+                                       _init_count_worker, (tokenizer,)):
+            for counter, chunk_counter in zip(counters, partial):
+                counter.update(chunk_counter)
+    return counters
+
+
+def encode_tokens(token_lists, max_length, token_to_index, pad_index, unk_index):
+    # ids are written straight into a pad-filled [batch, max_length] array
+    batch = np.full((len(token_lists), max_length), pad_index, dtype=np.int32)
+    lengths = np.array([min(len(tokens), max_length) for tokens in token_lists], dtype=np.int64)
+    get = token_to_index.get
+    ids = [get(token, unk_index) for tokens in token_lists for token in tokens[:max_length]]
+    if ids:
+        batch[np.arange(max_length) < lengths[:, None]] = ids
+    return batch
+
+
+def bucket_length(length, boundaries, max_length):
+    i = bisect.bisect_left(boundaries, length)
+    return min(boundaries[i], max_length) if i < len(boundaries) else max_length
+
+
+VOCAB_MAGIC = b'SQVOCAB\x01'
+
+
+class VocabularyTokens(Sequence):
+    # id -> token view of a VocabularyTable
+    def __init__(self, sorted_tokens, positions):
+        self._sorted_tokens = sorted_tokens
+        self._positions = positions
+
+    def __getitem__(self, i):
+        return self._sorted_tokens[self._positions[i]].decode('utf-8')
+
+    def __iter__(self):
+        # one gather and one decode for the whole table
+        return iter(np.char.decode(self._sorted_tokens[self._positions], 'utf-8').tolist())
+
+    def __len__(self):
+        return len(self._positions)
+
+
+class VocabularyTable(Mapping):
+    # token -> id over a memory-mapped .vocab file laid out as
+    # magic | int64 [size, width] | S{width} sorted tokens | int32 ids of the sorted tokens |
+    # int32 sorted position of each id
+    def __init__(self, filename):
+        header = np.memmap(filename, dtype=np.int64, mode='r', offset=len(VOCAB_MAGIC), shape=(2,))
+        size, width = int(header[0]), int(header[1])
+        offset = len(VOCAB_MAGIC) + header.nbytes
+        self._sorted_tokens = np.memmap(
+            filename, dtype=f'S{width}', mode='r', offset=offset, shape=(size,))
+        offset += size * width
+        self._sorted_ids = np.memmap(filename, dtype=np.int32, mode='r', offset=offset, shape=(size,))
+        offset += size * 4
+        self._positions = np.memmap(filename, dtype=np.int32, mode='r', offset=offset, shape=(size,))
+        self.tokens = VocabularyTokens(self._sorted_tokens, self._positions)
+
+    @staticmethod
+    def save(index_to_token, filename):
+        tokens = np.array([token.encode('utf-8') for token in index_to_token], dtype=np.bytes_)
+        order = np.argsort(tokens, kind='stable').astype(np.int32)
+        positions = np.empty_like(order)
+        positions[order] = np.arange(len(order), dtype=np.int32)
+        with open(filename, mode='wb') as f:
+            f.write(VOCAB_MAGIC)
+            f.write(np.array([len(tokens), tokens.dtype.itemsize], dtype=np.int64).tobytes())
+            f.write(tokens[order].tobytes())
+            f.write(order.tobytes())
+            f.write(positions.tobytes())
+
+    def _lookup(self, tokens):
+        queries = np.array([token.encode('utf-8') for token in tokens], dtype=np.bytes_)
+        positions = np.minimum(np.searchsorted(self._sorted_tokens, queries), len(self) - 1)
+        found = self._sorted_tokens[positions] == queries
+        return self._sorted_ids[positions], found
+
+    def __getitem__(self, token):
+        ids, found = self._lookup([token])
+        if not found[0]:
+            raise KeyError(token)
+        return int(ids[0])
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self._sorted_ids)
+
+    def items(self):
+        # (token, id) pairs in id order, without a search per token
+        return zip(self.tokens, range(len(self)))
+
+    def encode(self, token_lists, max_length=None, pad_index=0, unk_index=1):
+        # one searchsorted over the distinct tokens of the batch, scattered into a padded array
+        if max_length is None:
+            max_length = max((len(tokens) for tokens in token_lists), default=0)
+        lengths = np.array([min(len(tokens), max_length) for tokens in token_lists], dtype=np.int64)
+        batch = np.full((len(token_lists), max_length), pad_index, dtype=np.int32)
+        tokens = [token for tokens in token_lists for token in tokens[:max_length]]
+        if tokens:
+            # each distinct token of the batch is searched once, then mapped back by its
+            # inverse index; a dict dedups faster than np.unique over a string array
+            uniques = {}
+            inverse = np.fromiter(
+                [uniques.setdefault(token, len(uniques)) for token in tokens],
+                dtype=np.int64, count=len(tokens))
+            ids, found = self._lookup(list(uniques))
+            ids = np.where(found, ids, unk_index).astype(np.int32)
+            batch[np.arange(max_length) < lengths[:, None]] = ids[inverse]
+        return batch
 
 
 class Vocabulary:
@@ -47,13 +183,21 @@ class Vocabulary:
     def build(tokens, min_count, max_vocab_size, speicial_tokens, savefile=None):
         token_to_index, index_to_token = make_vocab(tokens, min_count, max_vocab_size, speicial_tokens)
         if savefile is not None:
-            with open(savefile, mode='wb') as f:
-                pickle.dump((token_to_index, index_to_token), f)
+            if savefile.endswith('.vocab'):
+                VocabularyTable.save(index_to_token, savefile)
+            else:
+                with open(savefile, mode='wb') as f:
+                    pickle.dump((token_to_index, index_to_token), f)
         return token_to_index, index_to_token
 
     @staticmethod
     def load(filename):
+        # binary .vocab files are memory-mapped, anything else is the pickled pair
         with open(filename, mode='rb') as f:
+            if f.read(len(VOCAB_MAGIC)) == VOCAB_MAGIC:
+                table = VocabularyTable(filename)
+                return table, table.tokens
+            f.seek(0)
             token_to_index, index_to_token = pickle.load(f)
         return token_to_index, index_to_token
 
@@ -61,26 +205,72 @@ class Vocabulary:
 class SquadReader:
     def __init__(self, filename):
         self._filename = filename
-        with open(filename) as f:
-            self._total_data = len(f.readlines())
+        self._offsets = load_line_offsets(filename)
+        self._total_data = len(self._offsets) - 1
+        self._buffer = None
+
+    def _read(self, start, stop):
+        if self._buffer is None:
+            with open(self._filename, 'rb') as f:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        begin, end = int(self._offsets[start]), int(self._offsets[stop])
+        return self._buffer[begin:end].decode('utf-8')
 
     def __getitem__(self, i):
         if isinstance(i, slice):
-            lines = [
-                linecache.getline(self._filename, i + 1)
-                for i in range(i.start or 0, min(i.stop, len(self)), i.step or 1)]
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            if start >= stop:
+                return []
+            lines = io.StringIO(self._read(start, stop))
             data = [row for row in csv.reader(lines, delimiter='\t')]
         else:
-            if i > self._total_data:
+            if i < 0:
+                i += self._total_data
+            if not 0 <= i < self._total_data:
                 raise IndexError('Invalid Index')
-            lines = [linecache.getline(self._filename, i + 1)]
+            lines = [self._read(i, i + 1)]
             data = next(csv.reader(lines, delimiter='\t'))
         return data
 
+    def take(self, indices):
+        if len(indices) and indices[-1] - indices[0] == len(indices) - 1 and \
+           np.all(np.diff(indices) == 1):
+            return self[int(indices[0]):int(indices[-1]) + 1]
+        return [self[int(index)] for index in indices]
+
     def __len__(self):
         return self._total_data
 
 
+class Subset:
+    # view on the rows [start, stop) of a dataset, e.g. one shard per worker
+    def __init__(self, dataset, start, stop):
+        self._dataset = dataset
+        self._start, self._stop, _ = slice(start, stop).indices(len(dataset))
+        self._stop = max(self._stop, self._start)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            return self._dataset[self._start + start:self._start + stop:step]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Invalid Index')
+        return self._dataset[self._start + i]
+
+    def take(self, indices):
+        indices = np.asarray(indices) + self._start
+        if hasattr(self._dataset, 'take'):
+            return self._dataset.take(indices)
+        return [self._dataset[int(index)] for index in indices]
+
+    def __len__(self):
+        return self._stop - self._start
+
+
 class Iterator:
     def __init__(self, dataset, batch_size, converter, repeat=True, shuffle=True):
         self._dataset = dataset
@@ -89,16 +279,33 @@ class Iterator:
         self._repeat = repeat
         self._shuffle = shuffle
         self._epoch = 0
+        # a generator of its own so that its state can be saved with the position;
+        # seeded from the global one, so np.random.seed still fixes the order
+        self._random = np.random.RandomState(np.random.randint(2 ** 31 - 1))
 
         self.reset()
 
     def reset(self):
         self._current_position = 0
         if self._shuffle:
-            self._order = np.random.permutation(len(self._dataset))
+            self._order = self._random.permutation(len(self._dataset))
         else:
             self._order = None
 
+    def get_state(self):
+        # the order is replaced on every reshuffle, never modified, so it is not copied
+        return {'epoch': self._epoch, 'position': self._current_position,
+                'order': self._order, 'random': self._random.get_state()}
+
+    def set_state(self, state, skip=0):
+        # restores a state from get_state, then draws the indices of skip batches without loading them
+        self._epoch = state['epoch']
+        self._current_position = state['position']
+        self._order = state['order']
+        self._random.set_state(state['random'])
+        for _ in range(skip):
+            self._next_indices()
+
     def __len__(self):
         return math.ceil(len(self._dataset) / self._batch_size)
 
@@ -106,6 +313,9 @@ class Iterator:
         return self
 
     def __next__(self):
+        return self._load(self._next_indices())
+
+    def _next_indices(self):
         if not self._repeat and self._epoch > 0:
             raise StopIteration
         i = self._current_position
@@ -113,17 +323,18 @@ class Iterator:
         N = len(self._dataset)
 
         if self._order is not None:
-            batch = [self._dataset[index] for index in self._order[i:i_end]]
+            indices = self._order[i:i_end]
         else:
-            batch = self._dataset[i:i_end]
+            indices = np.arange(i, min(i_end, N))
 
         if i_end >= N:
             if self._repeat:
                 rest = i_end - N
-                np.random.shuffle(self._order)
+                if self._shuffle:
+                    self._order = self._random.permutation(N)
                 if rest > 0:
-                    batch.extend(
-                        [self._dataset[index] for index in self._order[:rest]])
+                    head = self._order[:rest] if self._order is not None else np.arange(rest)
+                    indices = np.concatenate([indices, head])
                 self._current_position = rest
             else:
                 self._current_position = 0
@@ -132,63 +343,371 @@ class Iterator:
         else:
             self._current_position = i_end
 
+        return indices
+
+    def _load(self, indices):
+        if hasattr(self._dataset, 'take'):
+            batch = self._dataset.take(indices)
+        else:
+            batch = [self._dataset[index] for index in indices]
         return self._converter(batch)
 
 
+class BucketIterator(Iterator):
+    def __init__(self, dataset, batch_size, converter, lengths, boundaries,
+                 repeat=True, shuffle=True):
+        bucket_ids = np.searchsorted(boundaries, lengths)
+        self._buckets = [
+            np.flatnonzero(bucket_ids == i) for i in range(len(boundaries) + 1)]
+        self._buckets = [bucket for bucket in self._buckets if len(bucket)]
+        super().__init__(dataset, batch_size, converter, repeat, shuffle)
+
+    def reset(self):
+        self._current_position = 0
+        self._order = None
+        self._batches = self._make_batches()
+
+    def _make_batches(self):
+        batches = []
+        for bucket in self._buckets:
+            if self._shuffle:
+                bucket = self._random.permutation(bucket)
+            batches.extend(
+                bucket[i:i + self._batch_size] for i in range(0, len(bucket), self._batch_size))
+        if self._shuffle:
+            batches = [batches[i] for i in self._random.permutation(len(batches))]
+        return batches
+
+    def get_state(self):
+        state = super().get_state()
+        state['batches'] = self._batches
+        return state
+
+    def set_state(self, state, skip=0):
+        self._batches = state['batches']
+        super().set_state(state, skip)
+
+    def __len__(self):
+        return len(self._batches)
+
+    def _next_indices(self):
+        if not self._repeat and self._epoch > 0:
+            raise StopIteration
+        indices = self._batches[self._current_position]
+        self._current_position += 1
+        if self._current_position >= len(self._batches):
+            self._current_position = 0
+            if self._repeat and self._shuffle:
+                self._batches = self._make_batches()
+            self._epoch += 1
+        return indices
+
+
+_prefetch_iterator = None
+
+
+def _init_prefetch_worker(iterator):
+    global _prefetch_iterator
+    _prefetch_iterator = iterator
+    # pool workers are daemonic and cannot start the processes of nlp.pipe(n_process>1)
+    if getattr(iterator._converter, 'n_process', 1) > 1:
+        iterator._converter.n_process = 1
+
+
+def _span_counts(converter):
+    # the alignment counters of a SquadConverter, (0, 0) for other converters
+    return getattr(converter, 'total_spans', 0), getattr(converter, 'misaligned_spans', 0)
+
+
+def _prefetch_batch(indices):
+    # the counters of the worker's converter copy are returned with the batch
+    converter = _prefetch_iterator._converter
+    total, misaligned = _span_counts(converter)
+    batch = _prefetch_iterator._load(indices)
+    new_total, new_misaligned = _span_counts(converter)
+    return batch, (new_total - total, new_misaligned - misaligned)
+
+
+class PrefetchIterator:
+    def __init__(self, iterator, num_workers=2, prefetch=4):
+        self._iterator = iterator
+        self._prefetch = prefetch
+        # workers inherit the dataset and converter via fork, so neither needs to be picklable
+        context = multiprocessing.get_context('fork')
+        self._pool = context.Pool(num_workers, _init_prefetch_worker, (iterator,))
+        self._pending = deque()
+        self._exhausted = False
+        self._fill()
+
+    def _fill(self):
+        while not self._exhausted and len(self._pending) < self._prefetch:
+            # the state before drawing a batch is the state once the previous one is consumed
+            state = self._iterator.get_state()
+            try:
+                indices = self._iterator._next_indices()
+            except StopIteration:
+                self._exhausted = True
+                break
+            self._pending.append((state, self._pool.apply_async(_prefetch_batch, (indices,))))
+
+    def get_state(self):
+        # the state of the wrapped iterator after the batches returned so far, not the prefetched ones
+        if self._pending:
+            return self._pending[0][0]
+        return self._iterator.get_state()
+
+    def set_state(self, state, skip=0):
+        # batches already prefetched are dropped
+        self._pending.clear()
+        self._exhausted = False
+        self._iterator.set_state(state, skip)
+        self._fill()
+
+    def __len__(self):
+        return len(self._iterator)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._pending:
+            raise StopIteration
+        _, result = self._pending.popleft()
+        self._fill()
+        batch, (total, misaligned) = result.get()
+        if total:
+            # gathered into the parent's converter, as if it had converted the batch itself
+            converter = self._iterator._converter
+            converter.total_spans += total
+            converter.misaligned_spans += misaligned
+        return batch
+
+    def close(self):
+        self._pending.clear()
+        self._exhausted = True
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SquadCache:
+    fields = ('context', 'question', 'context_length', 'question_length',
+              'context_offsets', 'span')
+
+    def __init__(self, dirname):
+        self._dirname = dirname
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self._arrays = [
+            np.load(os.path.join(dirname, f'{name}.npy'), mmap_mode='r')
+            for name in self.fields]
+        self._total_data = self.meta['size']
+
+    @staticmethod
+    def build(dataset, converter, dirname, chunk_size=1000):
+        os.makedirs(dirname, exist_ok=True)
+        size = len(dataset)
+        context_max_len = converter._context_max_len
+        question_max_len = converter._question_max_len
+        shapes = {
+            'context': ((size, context_max_len), np.int32),
+            'question': ((size, question_max_len), np.int32),
+            'context_length': ((size,), np.int32),
+            'question_length': ((size,), np.int32),
+            'context_offsets': ((size, context_max_len, 2), np.int32),
+            'span': ((size, 2), np.int32)}
+        arrays = {
+            name: np.lib.format.open_memmap(
+                os.path.join(dirname, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+            for name, (shape, dtype) in shapes.items()}
+
+        misaligned = 0
+        for i in range(0, size, chunk_size):
+            batch = dataset[i:i + chunk_size]
+            i_end = i + len(batch)
+            contexts, questions, starts, ends = zip(*(row[:4] for row in batch))
+            contexts, questions = converter._tokenize(contexts, questions)
+            starts = [int(start) for start in starts]
+            ends = [int(end) for end in ends]
+
+            arrays['context'][i:i_end] = converter._process_text(contexts, context_max_len)
+            arrays['question'][i:i_end] = converter._process_text(questions, question_max_len)
+            arrays['context_length'][i:i_end] = [min(len(x), context_max_len) for x in contexts]
+            arrays['question_length'][i:i_end] = [min(len(x), question_max_len) for x in questions]
+            for j, context in enumerate(contexts, i):
+                offsets = [(token.idx, token.idx + len(token.text))
+                           for token in context[:context_max_len]]
+                if offsets:
+                    arrays['context_offsets'][j, :len(offsets)] = offsets
+            arrays['span'][i:i_end], errors = get_spans(contexts, starts, ends, return_errors=True)
+            misaligned += int(errors.sum())
+
+        for array in arrays.values():
+            array.flush()
+        meta = {'size': size, 'context_max_len': context_max_len,
+                'question_max_len': question_max_len,
+                'vocab_size': len(converter._token_to_index),
+                'misaligned': misaligned}
+        with open(os.path.join(dirname, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return SquadCache(dirname)
+
+    def check(self, vocab_size, context_max_len, question_max_len):
+        # the ids and padded lengths of a cache only hold for the setup it was built with
+        expected = {'vocab_size': vocab_size, 'context_max_len': context_max_len,
+                    'question_max_len': question_max_len}
+        mismatches = [f'{key} is {self.meta[key]}, expected {value}'
+                      for key, value in expected.items() if self.meta[key] != value]
+        if mismatches:
+            raise ValueError(f'{self._dirname} was built with a different setup '
+                             f'({"; ".join(mismatches)}), rebuild it with prepare_dataset.py')
+
+    @staticmethod
+    def path(filename):
+        root, _ = os.path.splitext(filename)
+        return f'{root}_cache'
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(zip(*(array[i] for array in self._arrays)))
+        if i < 0:
+            i += self._total_data
+        if not 0 <= i < self._total_data:
+            raise IndexError('Invalid Index')
+        return tuple(array[i] for array in self._arrays)
+
+    def take(self, indices):
+        return list(zip(*(array[indices] for array in self._arrays)))
+
+    @property
+    def context_lengths(self):
+        return self._arrays[2]
+
+    @property
+    def misaligned(self):
+        # answers whose span was aligned to the nearest tokens when the cache was built
+        return self.meta.get('misaligned', 0)
+
+    def __len__(self):
+        return self._total_data
+
+
+class SquadCacheConverter:
+    def __init__(self, bucket_boundaries=None):
+        self._bucket_boundaries = bucket_boundaries
+
+    def __call__(self, batch):
+        contexts, questions, context_lengths, question_lengths, _, spans = zip(*batch)
+        context_batch = np.stack(contexts)
+        question_batch = np.stack(questions)
+        if self._bucket_boundaries is not None:
+            context_len = bucket_length(
+                max(max(context_lengths), 1), self._bucket_boundaries, context_batch.shape[1])
+            question_len = max(max(question_lengths), 1)
+            context_batch = context_batch[:, :context_len]
+            question_batch = question_batch[:, :question_len]
+        spans = np.stack(spans)
+        start_batch = np.ascontiguousarray(spans[:, 0])
+        end_batch = np.ascontiguousarray(spans[:, 1])
+        return [question_batch, context_batch], [start_batch, end_batch]
+
+
 class SquadConverter:
     def __init__(self, token_to_index, pad_token, unk_token, lower=True,
-                 question_max_len=50, context_max_len=400):
+                 question_max_len=50, context_max_len=400, pipe_batch_size=256, n_process=1,
+                 bucket_boundaries=None):
         spacy_en = spacy.load(
             'en_core_web_sm', disable=['vectors', 'textcat', 'tagger', 'parser', 'ner'])
 
         def tokenizer(x):
             return [token for token in spacy_en(x) if not token.is_space]
 
+        def batch_tokenizer(xs):
+            docs = spacy_en.pipe(xs, batch_size=pipe_batch_size, n_process=self.n_process)
+            return [[token for token in doc if not token.is_space] for doc in docs]
+
+        self.n_process = n_process
         self._tokenizer = tokenizer
+        self._batch_tokenizer = batch_tokenizer
         self._token_to_index = token_to_index
         self._pad_token = pad_token
+        self._pad_index = token_to_index[pad_token]
         self._unk_index = token_to_index[unk_token]
         self._lower = str.lower if lower else lambda x: x
         self._question_max_len = question_max_len
         self._context_max_len = context_max_len
+        self._bucket_boundaries = bucket_boundaries
+        # answers whose character span does not fall on token boundaries
+        self.total_spans = 0
+        self.misaligned_spans = 0
 
     def __call__(self, batch):
-        contexts, questions, starts, ends, answers = zip(*batch)
+        # columns after the fourth hold one or more answers
+        contexts, questions, starts, ends = zip(*(row[:4] for row in batch))
 
-        contexts = [self._tokenizer(context) for context in contexts]
-        questions = [self._tokenizer(question) for question in questions]
+        contexts, questions = self._tokenize(contexts, questions)
         starts = [int(start) for start in starts]
         ends = [int(end) for end in ends]
-        starts, ends = zip(*get_spans(contexts, starts, ends))
+        spans, errors = get_spans(contexts, starts, ends, return_errors=True)
+        self.total_spans += len(spans)
+        self.misaligned_spans += int(errors.sum())
+        starts, ends = zip(*spans)
 
-        context_batch = self._process_text(contexts, self._context_max_len)
-        question_batch = self._process_text(questions, self._question_max_len)
+        context_batch = self._process_text(contexts, self._context_length(contexts))
+        question_batch = self._process_text(questions, self._question_length(questions))
         start_batch = np.array(starts, dtype=np.int32)
         end_batch = np.array(ends, dtype=np.int32)
         return [question_batch, context_batch], [start_batch, end_batch]
 
+    def _context_length(self, contexts):
+        if self._bucket_boundaries is None:
+            return self._context_max_len
+        length = max(max(len(context) for context in contexts), 1)
+        return bucket_length(length, self._bucket_boundaries, self._context_max_len)
+
+    def _question_length(self, questions):
+        if self._bucket_boundaries is None:
+            return self._question_max_len
+        length = max(max(len(question) for question in questions), 1)
+        return min(length, self._question_max_len)
+
+    def _tokenize(self, *fields):
+        # a single nlp.pipe call over every field of the batch
+        docs = iter(self._batch_tokenizer([text for field in fields for text in field]))
+        return [[next(docs) for _ in field] for field in fields]
+
     def _process_text(self, texts, max_length):
-        texts = [[self._lower(token.text) for token in text] for text in texts]
-        length = max(len(text) for text in texts)
-        if length > max_length:
-            texts = [text[:max_length] for text in texts]
-        texts = [x + [self._pad_token] * (max_length - len(x)) for x in texts]
-        return np.array([
-            [self._token_to_index.get(token, self._unk_index) for token in text]
-            for text in texts], dtype=np.int32)
+        texts = [[self._lower(token.text) for token in text[:max_length]] for text in texts]
+        if isinstance(self._token_to_index, VocabularyTable):
+            return self._token_to_index.encode(texts, max_length, self._pad_index, self._unk_index)
+        return encode_tokens(texts, max_length, self._token_to_index, self._pad_index, self._unk_index)
 
 
 class SquadDepConverter:
     def __init__(self, token_to_index, pad_token, unk_token, lower=True,
-                 question_max_len=50):
+                 question_max_len=50, pipe_batch_size=256, n_process=1):
         spacy_en = spacy.load(
             'en_core_web_sm', disable=['vectors', 'textcat', 'tagger', 'ner'])
 
-        def token_and_dep(x):
-            token, dep = zip(*([token.text, token.dep_] for token in spacy_en(x) if not token.is_space))
+        def doc_to_token_and_dep(doc):
+            token, dep = zip(*([token.text, token.dep_] for token in doc if not token.is_space))
             return token, dep
 
+        def token_and_dep(x):
+            return doc_to_token_and_dep(spacy_en(x))
+
+        def batch_token_and_dep(xs):
+            docs = spacy_en.pipe(xs, batch_size=pipe_batch_size, n_process=self.n_process)
+            return [doc_to_token_and_dep(doc) for doc in docs]
+
+        self.n_process = n_process
         self._token_and_dep = token_and_dep
+        self._batch_token_and_dep = batch_token_and_dep
         self._token_to_index = token_to_index
         LABELS[pad_token] = len(LABELS)
         self._dep_to_index = LABELS
@@ -199,36 +718,36 @@ class SquadDepConverter:
         self._question_max_len = question_max_len
 
     def __call__(self, batch):
-        _, questions, _, _, _ = zip(*batch)
+        questions = [row[1] for row in batch]
 
-        tokens, deps = zip(*(self._token_and_dep(question) for question in questions))
+        tokens, deps = zip(*self._batch_token_and_dep(questions))
         inputs = self._process_text(tokens, self._question_max_len, self._token_to_index, self._unk_index)
         outputs = self._process_text(deps, self._question_max_len, self._dep_to_index, self._unk_dep)
         return inputs, outputs[:, :, None]
 
     def _process_text(self, texts, max_length, token_to_index, unk_index):
-        texts = [[self._lower(token) for token in text] for text in texts]
-        length = max(len(text) for text in texts)
-        if length > max_length:
-            texts = [text[:max_length] for text in texts]
-        texts = [x + [self._pad_token] * (max_length - len(x)) for x in texts]
-        return np.array([
-            [token_to_index.get(token, unk_index) for token in text]
-            for text in texts], dtype=np.int32)
+        texts = [[self._lower(token) for token in text[:max_length]] for text in texts]
+        pad_index = token_to_index.get(self._pad_token, unk_index)
+        if isinstance(token_to_index, VocabularyTable):
+            return token_to_index.encode(texts, max_length, pad_index, unk_index)
+        return encode_tokens(texts, max_length, token_to_index, pad_index, unk_index)
 
 
 class SquadTestConverter(SquadConverter):
     def __call__(self, batch):
-        contexts, questions, _, _, answers = zip(*batch)
-        contexts = [self._tokenizer(context) for context in contexts]
-        questions = [self._tokenizer(question) for question in questions]
-        answers = self._get_valid_tokenized_answers(answers)
-        context_batch = self._process_text(contexts, self._context_max_len)
-        question_batch = self._process_text(questions, self._question_max_len)
+        contexts, questions = zip(*(row[:2] for row in batch))
+        contexts, questions = self._tokenize(contexts, questions)
+        # every ground truth answer of each example, tokenized in one pipe call
+        answers = [row[4:] for row in batch]
+        tokenized = iter(self._get_valid_tokenized_answers(
+            [answer for row in answers for answer in row]))
+        answers = [[next(tokenized) for _ in row] for row in answers]
+        context_batch = self._process_text(contexts, self._context_length(contexts))
+        question_batch = self._process_text(questions, self._question_length(questions))
         return [question_batch, context_batch], answers
 
     def _get_valid_tokenized_answers(self, answers):
         return [
-            ' '.join([token.text for token in self._tokenizer(answer)])
-            for answer in answers
+            ' '.join(token.text for token in answer)
+            for answer in self._batch_tokenizer(answers)
         ]
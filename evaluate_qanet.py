@@ -1,36 +1,83 @@
 import os
+import multiprocessing
 from argparse import ArgumentParser
 
 import numpy as np
 
-from models import QANet
-from data import SquadReader, Iterator, Vocabulary, SquadTestConverter
+from models import QANet, span_model
+from data import SquadReader, Subset, Iterator, Vocabulary, SquadTestConverter
 from metrics import SquadMetric
-from utils import evaluate
+from utils import evaluate, visualize_attention
 
 from prepare_vocab import PAD_TOKEN, UNK_TOKEN
 
 
-def main(args):
-    token_to_index, index_to_token = Vocabulary.load(args.vocab_file)
-
+def load_model(args, vocab_size):
     root, _ = os.path.splitext(args.vocab_file)
     basepath, basename = os.path.split(root)
     embed_path = f'{basepath}/embedding_{basename}.npy'
     embeddings = np.load(embed_path) if os.path.exists(embed_path) else None
 
-    model = QANet(len(token_to_index), args.embed, args.hidden, args.num_heads,
+    model = QANet(vocab_size, args.embed, args.hidden, args.num_heads,
                   encoder_num_blocks=args.encoder_layer, encoder_num_convs=args.encoder_conv,
                   output_num_blocks=args.output_layer, output_num_convs=args.output_conv,
-                  dropout=args.dropout, embeddings=embeddings).build()
+                  dropout=args.dropout, embeddings=embeddings,
+                  compute_dtype=args.compute_dtype).build()
     model.load_weights(args.model_path)
+    return model
+
+
+def evaluate_shard(args, start, stop):
+    # runs in a spawned worker: its own TF session, limited to its share of the cores
+    import tensorflow as tf
+    from keras import backend as K
 
+    threads = max(1, multiprocessing.cpu_count() // args.workers)
+    K.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)))
+
+    token_to_index, index_to_token = Vocabulary.load(args.vocab_file)
+    model = load_model(args, len(token_to_index))
     metric = SquadMetric()
-    test_dataset = SquadReader(args.test_path)
+    test_dataset = Subset(SquadReader(args.test_path), start, stop)
     converter = SquadTestConverter(token_to_index, PAD_TOKEN, UNK_TOKEN, lower=args.lower)
     test_generator = Iterator(test_dataset, args.batch, converter, False, False)
-    em_score, f1_score = evaluate(model, test_generator, metric, index_to_token)
-    print('EM: {}, F1: {}'.format(em_score, f1_score))
+    evaluate(span_model(model), test_generator, metric, index_to_token)
+    return metric
+
+
+def evaluate_sharded(args):
+    total = len(SquadReader(args.test_path))
+    bounds = [total * i // args.workers for i in range(args.workers + 1)]
+    shards = [(args, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    # spawn, not fork: every worker builds its own TF graph and session
+    with multiprocessing.get_context('spawn').Pool(args.workers) as pool:
+        metrics = pool.starmap(evaluate_shard, shards)
+    metric = SquadMetric()
+    for partial in metrics:
+        metric.merge(partial)
+    return metric.get_metric()
+
+
+def main(args):
+    if args.workers > 1:
+        em_score, f1_score = evaluate_sharded(args)
+        print('EM: {}, F1: {}'.format(em_score, f1_score))
+        if not args.visualize_ids:
+            return
+
+    token_to_index, index_to_token = Vocabulary.load(args.vocab_file)
+    model = load_model(args, len(token_to_index))
+
+    test_dataset = SquadReader(args.test_path)
+    converter = SquadTestConverter(token_to_index, PAD_TOKEN, UNK_TOKEN, lower=args.lower)
+    if args.workers <= 1:
+        metric = SquadMetric()
+        test_generator = Iterator(test_dataset, args.batch, converter, False, False)
+        em_score, f1_score = evaluate(span_model(model), test_generator, metric, index_to_token)
+        print('EM: {}, F1: {}'.format(em_score, f1_score))
+    if args.visualize_ids:
+        visualize_attention(model, test_dataset, converter, args.visualize_ids, index_to_token)
 
 
 if __name__ == '__main__':
@@ -44,9 +91,12 @@ if __name__ == '__main__':
     parser.add_argument('--output-layer', default=7, type=int)
     parser.add_argument('--output-conv', default=2, type=int)
     parser.add_argument('--dropout', default=.1, type=float)
+    parser.add_argument('--compute-dtype', default='float32', choices=['float32', 'float16'])
     parser.add_argument('--test-path', default='./data/dev-v1.1_filtered.txt', type=str)
     parser.add_argument('--vocab-file', default='./data/vocab_question_context_min-freq10_max_size.pkl', type=str)
     parser.add_argument('--lower', default=False, action='store_true')
     parser.add_argument('--model-path', type=str)
+    parser.add_argument('--workers', default=1, type=int)
+    parser.add_argument('--visualize-ids', nargs='*', default=[], type=int)
     args = parser.parse_args()
     main(args)
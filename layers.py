@@ -4,6 +4,64 @@ import tensorflow as tf
 from keras import backend as K
 from keras.engine.topology import Layer
 from keras.layers import Conv1D, Lambda, Dropout, SeparableConv1D
+from keras.regularizers import Regularizer
+from keras import regularizers
+
+
+def cast_like(w, x):
+    # weights are kept in float32 and cast to the compute dtype of x where they are used
+    if w.dtype.base_dtype == x.dtype.base_dtype:
+        return w
+    return tf.cast(w, x.dtype.base_dtype)
+
+
+def mask_logits(x, mask, mask_value=None):
+    # masked entries are set to (not shifted by) the lowest value of the dtype,
+    # so they can never overflow to -inf whatever the dtype and the logits
+    mask = tf.cast(mask, x.dtype)
+    if mask_value is None:
+        mask_value = x.dtype.min
+    return x * mask + (1 - mask) * mask_value
+
+
+class Float32Regularizer(Regularizer):
+    # applies a regularizer to the float32 cast of its input, e.g. an activity
+    # regularizer on float16 outputs whose sum of squares would overflow
+    def __init__(self, regularizer):
+        self.regularizer = regularizers.get(regularizer)
+
+    def __call__(self, x):
+        return self.regularizer(tf.cast(x, tf.float32))
+
+    def get_config(self):
+        return {'regularizer': regularizers.serialize(self.regularizer)}
+
+
+class PrecisionConv1D(Conv1D):
+    # Conv1D that runs in the dtype of its inputs while its weights stay float32
+    def call(self, inputs):
+        outputs = K.conv1d(
+            inputs, cast_like(self.kernel, inputs), strides=self.strides[0], padding=self.padding,
+            data_format=self.data_format, dilation_rate=self.dilation_rate[0])
+        if self.use_bias:
+            outputs = K.bias_add(outputs, cast_like(self.bias, inputs), data_format=self.data_format)
+        if self.activation is not None:
+            return self.activation(outputs)
+        return outputs
+
+
+class PrecisionSeparableConv1D(SeparableConv1D):
+    # SeparableConv1D that runs in the dtype of its inputs while its weights stay float32
+    def call(self, inputs):
+        outputs = K.separable_conv1d(
+            inputs, cast_like(self.depthwise_kernel, inputs), cast_like(self.pointwise_kernel, inputs),
+            data_format=self.data_format, strides=self.strides, padding=self.padding,
+            dilation_rate=self.dilation_rate)
+        if self.use_bias:
+            outputs = K.bias_add(outputs, cast_like(self.bias, inputs), data_format=self.data_format)
+        if self.activation is not None:
+            return self.activation(outputs)
+        return outputs
 
 
 class SequenceLength(Lambda):
@@ -24,6 +82,7 @@ class PositionEmbedding(Layer):
     def __init__(self, min_timescale=1., max_timescale=1.e4, **kwargs):
         self.min_timescale = float(min_timescale)
         self.max_timescale = float(max_timescale)
+        self._signals = {}
         super().__init__(**kwargs)
 
     def get_timing_signal_1d(self, length, channels):
@@ -41,9 +100,17 @@ class PositionEmbedding(Layer):
         return signal
 
     def add_timing_signal_1d(self, x):
-        length = tf.shape(x)[1]  # sequence length
-        channels = tf.shape(x)[2]  # hidden dimension for each word
-        signal = self.get_timing_signal_1d(length, channels)
+        length, channels = x.shape.as_list()[1:]
+        dtype = x.dtype.base_dtype
+        if length is None or channels is None:
+            length = tf.shape(x)[1]  # sequence length
+            channels = tf.shape(x)[2]  # hidden dimension for each word
+            return x + tf.cast(self.get_timing_signal_1d(length, channels), dtype)
+        # static shapes share one signal per length and dtype in the graph
+        signal = self._signals.get((length, channels, dtype))
+        if signal is None or signal.graph is not x.graph:
+            signal = tf.cast(self.get_timing_signal_1d(length, channels), dtype)
+            self._signals[(length, channels, dtype)] = signal
         return x + signal
 
     def call(self, x):
@@ -53,6 +120,24 @@ class PositionEmbedding(Layer):
         return input_shape
 
 
+def attention_mask(seq_len, maxlen):
+    # seq_len: (batch, 1), mask: (batch, 1, seq_len)
+    mask = tf.sequence_mask(seq_len, maxlen=maxlen, dtype=tf.float32)
+    key_mask = tf.expand_dims(mask, axis=1)  # (batch, 1, 1, seq_len)
+    query_mask = tf.expand_dims(tf.transpose(mask, [0, 2, 1]), axis=1)  # (batch, 1, seq_len, 1)
+    return key_mask, query_mask
+
+
+class AttentionMask(Layer):
+    def call(self, inputs):
+        x, seq_len = inputs
+        return list(attention_mask(seq_len, tf.shape(x)[1]))
+
+    def compute_output_shape(self, input_shape):
+        batch, seq_len = input_shape[0][:2]
+        return [(batch, 1, 1, seq_len), (batch, 1, seq_len, 1)]
+
+
 class MultiHeadAttention(Layer):
     def __init__(self, input_dim, num_heads, initializer, regularizer, dropout, **kwargs):
         super().__init__(**kwargs)
@@ -81,57 +166,70 @@ class MultiHeadAttention(Layer):
         super().build(input_shape)
 
     def call(self, inputs, training=None):
-        q, k, v, seq_len = inputs
-
-        q = self.split_heads(K.conv1d(q, self.W_Q), self.num_heads)
-        k = self.split_heads(K.conv1d(k, self.W_K), self.num_heads)
-        v = self.split_heads(K.conv1d(v, self.W_V), self.num_heads)
+        if len(inputs) == 4:
+            q, k, v, seq_len = inputs
+            key_mask, query_mask = attention_mask(seq_len, tf.shape(k)[1])
+        else:
+            # masks prebuilt by AttentionMask and shared across blocks
+            q, k, v, key_mask, query_mask = inputs
+
+        if q is k and k is v:
+            # self-attention: one projection for Q, K and V
+            W = K.concatenate([self.W_Q, self.W_K, self.W_V], axis=-1)
+            q, k, v = tf.split(K.conv1d(q, cast_like(W, q)), 3, axis=-1)
+        else:
+            q = K.conv1d(q, cast_like(self.W_Q, q))
+            k = K.conv1d(k, cast_like(self.W_K, k))
+            v = K.conv1d(v, cast_like(self.W_V, v))
+        q = self.split_heads(q, self.num_heads)
+        k = self.split_heads(k, self.num_heads)
+        v = self.split_heads(v, self.num_heads)
 
         scale = self.d ** (1/2)
         q *= scale
-        x = self.dot_product_attention(q, k, v, seq_len, self.dropout, training)
+        x = self.dot_product_attention(q, k, v, key_mask, query_mask, self.dropout, training)
         x = self.combine_heads(x)
-        return K.conv1d(x, self.W_O)
+        return K.conv1d(x, cast_like(self.W_O, x))
 
     def split_heads(self, x, n):
-        shape = x.shape.as_list()
-        splitted = tf.reshape(x, [-1] + shape[1:-1] + [n, shape[-1] // n])
+        # the sequence length may only be known at run time
+        channels = x.shape.as_list()[-1]
+        shape = tf.shape(x)
+        splitted = tf.reshape(x, [shape[0], shape[1], n, channels // n])
         return tf.transpose(splitted, [0, 2, 1, 3])
 
     def combine_heads(self, x):
         x = tf.transpose(x, [0, 2, 1, 3])
-        shape = x.shape.as_list()
-        return tf.reshape(x, [-1] + shape[1:-2] + [shape[-2] * shape[-1]])
+        n, channels = x.shape.as_list()[-2:]
+        shape = tf.shape(x)
+        return tf.reshape(x, [shape[0], shape[1], n * channels])
 
-    def dot_product_attention(self, q, k, v, seq_len, dropout=.1, training=None):
+    def dot_product_attention(self, q, k, v, key_mask, query_mask, dropout=.1, training=None):
         logits = tf.matmul(q, k, transpose_b=True)
-        # logits = self.mask_logits(logits, seq_len)
-        # weights = tf.nn.softmax(logits, axis=-1)
-        weights = self.masked_softmax(logits, seq_len, axis=-1)
+        weights = tf.cast(self.masked_softmax(logits, key_mask, query_mask, axis=-1), v.dtype)
         weights = K.in_train_phase(tf.nn.dropout(weights, 1 - dropout), weights, training=training)
         return tf.matmul(weights, v)
 
-    def masked_softmax(self, x, mask, axis=-1, mask_value=tf.float32.min):
-        maxlen = x.shape.as_list()[-1]
-        # mask: (batch, 1, seq_len)
-        mask = tf.sequence_mask(mask, maxlen=maxlen, dtype=tf.float32)
-        mask = tf.expand_dims(tf.matmul(mask, mask, transpose_a=True), axis=1)  # (batch, 1, seq_len, seq_len)
-        x = x + (1 - mask) * mask_value
-        weights = tf.nn.softmax(x, axis=axis)
-        return weights * mask
+    def masked_softmax(self, x, key_mask, query_mask, axis=-1):
+        # key_mask: (batch, 1, 1, seq_len), query_mask: (batch, 1, seq_len, 1)
+        # the softmax always runs in float32
+        weights = tf.nn.softmax(mask_logits(tf.cast(x, tf.float32), key_mask), axis=axis)
+        return weights * query_mask
 
     def compute_output_shape(self, input_shape):
         return input_shape[1]
 
 
 class ContextQueryAttention(Layer):
-    def __init__(self, cont_limit, ques_limit, initializer, regularizer, dropout, **kwargs):
+    def __init__(self, cont_limit, ques_limit, initializer, regularizer, dropout,
+                 memory_efficient=True, **kwargs):
         super().__init__(**kwargs)
         self.cont_limit = cont_limit
         self.ques_limit = ques_limit
         self.initializer = initializer
         self.regularizer = regularizer
         self.dropout = dropout
+        self.memory_efficient = memory_efficient
 
     def build(self, input_shape):
         # (batch, seq_len, hidden_dim)
@@ -144,37 +242,57 @@ class ContextQueryAttention(Layer):
 
     def call(self, inputs):
         c, q, c_len, q_len = inputs
-        d = c.shape[-1]  # hidden_dim
+        # cont_limit and ques_limit may be None, so take the lengths at run time
+        cont_limit = tf.shape(c)[1]
+        ques_limit = tf.shape(q)[1]
 
         # similarity
-        c_tile = tf.tile(tf.expand_dims(c, 2), [1, 1, self.ques_limit, 1])
-        q_tile = tf.tile(tf.expand_dims(q, 1), [1, self.cont_limit, 1, 1])
-        total_len = self.ques_limit * self.cont_limit
-        c_mat = tf.reshape(c_tile, [-1, total_len, d])
-        q_mat = tf.reshape(q_tile, [-1, total_len, d])
-        c_q = c_mat * q_mat
-        weight_in = tf.concat([c_mat, q_mat, c_q], 2)
-        S = tf.reshape(K.conv1d(weight_in, self.W), [-1, self.cont_limit, self.ques_limit])
+        if self.memory_efficient:
+            S = self.similarity(c, q)
+        else:
+            S = self.tiled_similarity(c, q)
 
         # mask
         # mask: (batch, 1, c_len)
-        c_mask = tf.sequence_mask(c_len, maxlen=self.cont_limit, dtype=tf.float32)
+        c_mask = tf.sequence_mask(c_len, maxlen=cont_limit, dtype=tf.float32)
         # mask: (batch, 1, q_len)
-        q_mask = tf.sequence_mask(q_len, maxlen=self.ques_limit, dtype=tf.float32)
+        q_mask = tf.sequence_mask(q_len, maxlen=ques_limit, dtype=tf.float32)
         # mask: (batch, c_len, q_len)
         mask = tf.matmul(c_mask, q_mask, transpose_a=True)
 
-        # softmax
+        # softmax, in float32 whatever the dtype of c and q
         S_q = self.masked_softmax(S, mask, axis=2)
         S_c = self.masked_softmax(S, mask, axis=1)
-        a = tf.matmul(S_q, q)
-        b = tf.matmul(tf.matmul(S_q, S_c, transpose_b=True), c)
+        S_q_c, S_c_c = tf.cast(S_q, c.dtype), tf.cast(S_c, c.dtype)
+        a = tf.matmul(S_q_c, q)
+        b = tf.matmul(tf.matmul(S_q_c, S_c_c, transpose_b=True), c)
         x = tf.concat([c, a, c * a, c * b], axis=2)
         return [x, S_q, S_c]
 
-    def masked_softmax(self, x, mask, axis=-1, mask_value=tf.float32.min):
-        x = x + (1 - mask) * mask_value
-        weights = tf.nn.softmax(x, axis=axis)
+    def similarity(self, c, q):
+        # w . [c; q; c * q] == w_c . c + w_q . q + (c * w_cq) . q
+        d = c.shape.as_list()[-1]  # hidden_dim
+        W = tf.reshape(cast_like(self.W, c), [3 * d, 1])
+        s_c = K.dot(c, W[:d])  # (batch, c_len, 1)
+        s_q = tf.transpose(K.dot(q, W[d:2 * d]), [0, 2, 1])  # (batch, 1, q_len)
+        s_cq = tf.matmul(c * tf.reshape(W[2 * d:], [d]), q, transpose_b=True)  # (batch, c_len, q_len)
+        return s_c + s_q + s_cq
+
+    def tiled_similarity(self, c, q):
+        d = c.shape.as_list()[-1]  # hidden_dim
+        cont_limit = tf.shape(c)[1]
+        ques_limit = tf.shape(q)[1]
+        c_tile = tf.tile(tf.expand_dims(c, 2), [1, 1, ques_limit, 1])
+        q_tile = tf.tile(tf.expand_dims(q, 1), [1, cont_limit, 1, 1])
+        total_len = ques_limit * cont_limit
+        c_mat = tf.reshape(c_tile, [-1, total_len, d])
+        q_mat = tf.reshape(q_tile, [-1, total_len, d])
+        c_q = c_mat * q_mat
+        weight_in = tf.concat([c_mat, q_mat, c_q], 2)
+        return tf.reshape(K.conv1d(weight_in, cast_like(self.W, c)), [-1, cont_limit, ques_limit])
+
+    def masked_softmax(self, x, mask, axis=-1):
+        weights = tf.nn.softmax(mask_logits(tf.cast(x, tf.float32), mask), axis=axis)
         return weights * mask
 
     def compute_output_shape(self, input_shape):
@@ -215,10 +333,13 @@ class LayerNormalization(Layer):
         super().build(input_shape)
 
     def call(self, x):
+        # statistics in float32, the output in the dtype of x
+        dtype = x.dtype.base_dtype
+        x = tf.cast(x, tf.float32)
         mean = tf.reduce_mean(x, axis=-1, keepdims=True)
         variance = tf.reduce_mean(tf.square(x - mean), axis=-1, keepdims=True)
         normed_x = (x - mean) * tf.rsqrt(variance + K.epsilon())
-        return normed_x * self.gamma + self.beta
+        return tf.cast(normed_x * self.gamma + self.beta, dtype)
 
     def compute_output_shape(self, input_shape):
         return input_shape
@@ -230,10 +351,10 @@ class Highway:
         conv_layers = []
         for i in range(num_layers):
             conv_layers.append([
-                Conv1D(filters, 1, activation='sigmoid', kernel_initializer=initializer,
-                       kernel_regularizer=regularizer, bias_regularizer=regularizer),
-                Conv1D(filters, 1, activation='relu', kernel_initializer=initializer,
-                       kernel_regularizer=regularizer, bias_regularizer=regularizer)])
+                PrecisionConv1D(filters, 1, activation='sigmoid', kernel_initializer=initializer,
+                                kernel_regularizer=regularizer, bias_regularizer=regularizer),
+                PrecisionConv1D(filters, 1, activation='relu', kernel_initializer=initializer,
+                                kernel_regularizer=regularizer, bias_regularizer=regularizer)])
         self.conv_layers = conv_layers
 
     def __call__(self, x):
@@ -249,6 +370,8 @@ class Highway:
 class Encoder:
     def __init__(self, filters, kernel_size, num_blocks, num_convs, num_heads,
                  initializer=None, regularizer=None, dropout=.1):
+        # the outputs may be float16, so their penalty is computed in float32
+        activity_regularizer = Float32Regularizer(regularizer) if regularizer is not None else None
         conv_layers = []
         attention_layers = []
         feedforward_layers = []
@@ -256,61 +379,91 @@ class Encoder:
             conv_layers.append([])
             for j in range(num_convs):
                 conv_layers[i].append(
-                    SeparableConv1D(
+                    PrecisionSeparableConv1D(
                         filters, 7, padding='same', depthwise_initializer=initializer,
                         pointwise_initializer=initializer, depthwise_regularizer=regularizer,
                         pointwise_regularizer=regularizer, activation='relu',
-                        bias_regularizer=regularizer, activity_regularizer=regularizer))
+                        bias_regularizer=regularizer, activity_regularizer=activity_regularizer))
             attention_layers.append(
                 MultiHeadAttention(filters, num_heads, initializer, regularizer, dropout))
             feedforward_layers.append([
-                Conv1D(filters, 1, activation='relu', kernel_initializer=initializer,
-                       kernel_regularizer=regularizer, bias_regularizer=regularizer),
-                Conv1D(filters, 1, activation='linear', kernel_initializer=initializer,
-                       kernel_regularizer=regularizer, bias_regularizer=regularizer)])
+                PrecisionConv1D(filters, 1, activation='relu', kernel_initializer=initializer,
+                                kernel_regularizer=regularizer, bias_regularizer=regularizer),
+                PrecisionConv1D(filters, 1, activation='linear', kernel_initializer=initializer,
+                                kernel_regularizer=regularizer, bias_regularizer=regularizer)])
+
+        # the remaining per-block layers are created here too, so that applying
+        # the encoder several times reuses them instead of adding new ones
+        total_layer = (2 + num_convs) * num_blocks
+        sub_layer = 1
+        conv_norm_layers = []
+        conv_dropout_layers = []
+        attention_norm_layers = []
+        attention_dropout_layers = []
+        feedforward_norm_layers = []
+        feedforward_dropout_layers = []
+        for i in range(num_blocks):
+            conv_norm_layers.append([])
+            conv_dropout_layers.append([])
+            for j in range(num_convs):
+                conv_norm_layers[i].append(LayerNormalization())
+                conv_dropout_layers[i].append(
+                    self._make_dropout(sub_layer, total_layer, dropout))
+                sub_layer += 1
+            attention_norm_layers.append(LayerNormalization())
+            attention_dropout_layers.append(self._make_dropout(sub_layer, total_layer, dropout))
+            feedforward_norm_layers.append(LayerNormalization())
+            feedforward_dropout_layers.append(self._make_dropout(sub_layer, total_layer, dropout))
+            sub_layer += 1
 
         self.conv_layers = conv_layers
         self.attention_layers = attention_layers
         self.feedforward_layers = feedforward_layers
+        self.conv_norm_layers = conv_norm_layers
+        self.conv_dropout_layers = conv_dropout_layers
+        self.attention_norm_layers = attention_norm_layers
+        self.attention_dropout_layers = attention_dropout_layers
+        self.feedforward_norm_layers = feedforward_norm_layers
+        self.feedforward_dropout_layers = feedforward_dropout_layers
+        self.position_embedding = PositionEmbedding()
         self.num_blocks = num_blocks
         self.num_convs = num_convs
         self.dropout = dropout
 
-    def __call__(self, x, seq_len):
-        conv_layers = self.conv_layers
-        attention_layers = self.attention_layers
-        feedforward_layers = self.feedforward_layers
-        num_blocks = self.num_blocks
-        num_convs = self.num_convs
-        dropout = self.dropout
-        total_layer = (2 + num_convs) * num_blocks
-        sub_layer = 1
+    @staticmethod
+    def _make_dropout(sub_layer, total_layer, dropout):
+        # (Dropout or None, LayerDropout) applied at the end of a sublayer
+        return (Dropout(dropout) if sub_layer % 2 == 0 else None,
+                LayerDropout(dropout * (sub_layer / total_layer)))
 
-        for i in range(num_blocks):
-            x = PositionEmbedding()(x)
+    def __call__(self, x, seq_len, mask=None):
+        if mask is None:
+            mask = AttentionMask()([x, seq_len])
+
+        for i in range(self.num_blocks):
+            x = self.position_embedding(x)
             # convolution
-            for j in range(num_convs):
+            for j in range(self.num_convs):
                 residual = x
-                x = LayerNormalization()(x)
-                x = conv_layers[i][j](x)
-                if sub_layer % 2 == 0:
-                    x = Dropout(dropout)(x)
-                x = LayerDropout(dropout * (sub_layer / total_layer))([x, residual])
-                sub_layer += 1
+                x = self.conv_norm_layers[i][j](x)
+                x = self.conv_layers[i][j](x)
+                x = self._residual(x, residual, self.conv_dropout_layers[i][j])
             # attention
             residual = x
-            x = LayerNormalization()(x)
-            x = attention_layers[i]([x, x, x, seq_len])
-            if sub_layer % 2 == 0:
-                x = Dropout(dropout)(x)
-            x = LayerDropout(dropout * (sub_layer / total_layer))([x, residual])
+            x = self.attention_norm_layers[i](x)
+            x = self.attention_layers[i]([x, x, x] + mask)
+            x = self._residual(x, residual, self.attention_dropout_layers[i])
             # feed-forward
             residual = x
-            x = LayerNormalization()(x)
-            x = feedforward_layers[i][0](x)
-            x = feedforward_layers[i][1](x)
-            if sub_layer % 2 == 0:
-                x = Dropout(dropout)(x)
-            x = LayerDropout(dropout * (sub_layer / total_layer))([x, residual])
-            sub_layer += 1
+            x = self.feedforward_norm_layers[i](x)
+            x = self.feedforward_layers[i][0](x)
+            x = self.feedforward_layers[i][1](x)
+            x = self._residual(x, residual, self.feedforward_dropout_layers[i])
         return x
+
+    @staticmethod
+    def _residual(x, residual, dropout_layers):
+        dropout, layer_dropout = dropout_layers
+        if dropout is not None:
+            x = dropout(x)
+        return layer_dropout([x, residual])
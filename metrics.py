@@ -1,5 +1,10 @@
 import string
-from collections import Counter
+from collections import Counter, namedtuple
+
+
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+GroundTruth = namedtuple('GroundTruth', ['text', 'normalized', 'tokens', 'length'])
 
 
 def normalize_answer(text):
@@ -7,8 +12,7 @@ def normalize_answer(text):
         return ' '.join(text.split())
 
     def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(char for char in text if char not in exclude)
+        return text.translate(PUNCTUATION_TABLE)
 
     return white_space_fix(remove_punc(str.lower(text)))
 
@@ -40,21 +44,81 @@ def metric_max_over_ground_truths(metric_fn, prediction, ground_truths):
     return max(scores_for_groud_truths)
 
 
+def prepare_ground_truth(text):
+    normalized = normalize_answer(text)
+    tokens = normalized.split()
+    return GroundTruth(text, normalized, Counter(tokens), len(tokens))
+
+
+def prepared_scores(prediction, normalized, tokens, ground_truth):
+    # same results as exact_match_score and f1_score, without renormalizing
+    em = normalized == ground_truth.normalized
+    if prediction == ground_truth.text == '':
+        return em, 1
+    num_same = sum((tokens & ground_truth.tokens).values())
+    if num_same == 0:
+        return em, 0
+    precision = 1. * num_same / sum(tokens.values())
+    recall = 1. * num_same / ground_truth.length
+    f1 = (2 * precision * recall) / (precision + recall)
+    return em, f1
+
+
 class SquadMetric:
     def __init__(self):
         self._total_em = 0.
         self._total_f1 = 0.
         self._count = 0
+        # normalized ground truths are kept across resets and evaluation runs
+        self._ground_truths = {}
+
+    def __call__(self, best_span_string, answer_strings):
+        self._score(best_span_string, answer_strings)
+
+    def prepare(self, answers):
+        for answer in answers:
+            if isinstance(answer, str):
+                answer = (answer,)
+            for text in answer:
+                if text not in self._ground_truths:
+                    self._ground_truths[text] = prepare_ground_truth(text)
 
-    def __call__(self, best_span_string, answer_string):
-        em = metric_max_over_ground_truths(
-            exact_match_score, best_span_string, [answer_string])
-        f1 = metric_max_over_ground_truths(
-            f1_score, best_span_string, [answer_string])
-        self._total_em += em
-        self._total_f1 += f1
+    def update(self, best_span_strings, answer_strings):
+        for prediction, answers in zip(best_span_strings, answer_strings):
+            self._score(prediction, answers)
+
+    def _score(self, prediction, answers):
+        # answers: one ground truth string or all of them for the question
+        if isinstance(answers, str):
+            answers = (answers,)
+        ground_truths = self._ground_truths
+        normalized = normalize_answer(prediction)
+        tokens = Counter(normalized.split())
+        best_em = best_f1 = 0
+        for answer in answers:
+            ground_truth = ground_truths.get(answer)
+            if ground_truth is None:
+                ground_truth = ground_truths[answer] = prepare_ground_truth(answer)
+            em, f1 = prepared_scores(prediction, normalized, tokens, ground_truth)
+            best_em = max(best_em, em)
+            best_f1 = max(best_f1, f1)
+        self._total_em += best_em
+        self._total_f1 += best_f1
         self._count += 1
 
+    def merge(self, other):
+        # add the partial sums of another metric, e.g. from an evaluation shard
+        self._total_em += other._total_em
+        self._total_f1 += other._total_f1
+        self._count += other._count
+        return self
+
+    def __getstate__(self):
+        # the answer cache is rebuilt lazily, don't ship it between processes
+        state = self.__dict__.copy()
+        state['_ground_truths'] = {}
+        return state
+
     def get_metric(self, reset=False):
         em = self._total_em / self._count if self._count > 0 else 0
         f1 = self._total_f1 / self._count if self._count > 0 else 0
@@ -4,7 +4,8 @@ from keras.regularizers import l2
 from keras.layers import Input, Embedding, Concatenate, Lambda, \
     Conv1D, Masking, LSTM, Bidirectional, Dense, Dropout
 
-from layers import Highway, Encoder, ContextQueryAttention, SequenceLength
+from layers import Highway, Encoder, ContextQueryAttention, SequenceLength, AttentionMask, \
+    PrecisionConv1D, mask_logits
 
 
 class QANet:
@@ -12,10 +13,13 @@ class QANet:
                  encoder_num_blocks=1, encoder_num_convs=4, output_num_blocks=7, output_num_convs=2,
                  cont_limit=400, ques_limit=50, dropout=0.1, embeddings=None,
                  initializer=tf.variance_scaling_initializer(1, 'fan_in', distribution='normal'),
-                 regularizer=l2(3e-7)):
+                 regularizer=l2(3e-7), compute_dtype='float32'):
         self.cont_limit = cont_limit
         self.ques_limit = ques_limit
         self.dropout = dropout
+        # weights stay float32, activations between the embedding and the output softmax
+        # are computed in compute_dtype (float32 or float16)
+        self.compute_dtype = tf.as_dtype(compute_dtype)
         self.encoder_num_blocks = encoder_num_blocks
         self.encoder_num_convs = encoder_num_convs
         if embeddings is not None:
@@ -23,7 +27,7 @@ class QANet:
         self.embed_layer = Embedding(
             vocab_size, embed_size, weights=embeddings, trainable=False)
         self.highway = Highway(embed_size, 2, initializer, regularizer, dropout)
-        self.projection1 = Conv1D(
+        self.projection1 = PrecisionConv1D(
             filters, 1, activation='linear', kernel_initializer=initializer,
             kernel_regularizer=regularizer, bias_regularizer=regularizer)
 
@@ -31,17 +35,17 @@ class QANet:
                                num_heads, initializer, regularizer, dropout)
 
         self.coattention = ContextQueryAttention(cont_limit, ques_limit, initializer, regularizer, dropout)
-        self.projection2 = Conv1D(
+        self.projection2 = PrecisionConv1D(
             filters, 1, activation='linear', kernel_initializer=initializer,
             kernel_regularizer=regularizer, bias_regularizer=regularizer)
 
         self.output_layer = Encoder(filters, 5, output_num_blocks, output_num_convs,
                                     num_heads, initializer, regularizer, dropout)
 
-        self.start_layer = Conv1D(
+        self.start_layer = PrecisionConv1D(
             1, 1, activation='linear', kernel_initializer=initializer,
             kernel_regularizer=regularizer, bias_regularizer=regularizer)
-        self.end_layer = Conv1D(
+        self.end_layer = PrecisionConv1D(
             1, 1, activation='linear', kernel_initializer=initializer,
             kernel_regularizer=regularizer, bias_regularizer=regularizer)
 
@@ -52,34 +56,41 @@ class QANet:
         # (batch, 1)
         cont_len = SequenceLength()(cont_input)
         ques_len = SequenceLength()(ques_input)
+        # attention masks are built once and shared by every encoder block
+        cont_mask = AttentionMask()([cont_input, cont_len])
+        ques_mask = AttentionMask()([ques_input, ques_len])
+
+        def cast(x, dtype=self.compute_dtype):
+            return Lambda(lambda x: tf.cast(x, dtype))(x)
 
         # encoding each
-        x_cont = self.embed_layer(cont_input)
+        x_cont = cast(self.embed_layer(cont_input))
         x_cont = Dropout(self.dropout)(x_cont)
         x_cont = self.highway(x_cont)
         x_cont = self.projection1(x_cont)
-        x_cont = self.encoder(x_cont, cont_len)
+        x_cont = self.encoder(x_cont, cont_len, cont_mask)
 
-        x_ques = self.embed_layer(ques_input)
+        x_ques = cast(self.embed_layer(ques_input))
         x_ques = Dropout(self.dropout)(x_ques)
         x_ques = self.highway(x_ques)
         x_ques = self.projection1(x_ques)
-        x_ques = self.encoder(x_ques, ques_len)
+        x_ques = self.encoder(x_ques, ques_len, ques_mask)
 
         x, S_q, S_c = self.coattention([x_cont, x_ques, cont_len, ques_len])
         x = self.projection2(x)
 
         outputs = []
         for _ in range(3):
-            x = self.output_layer(x, cont_len)
+            x = self.output_layer(x, cont_len, cont_mask)
             outputs.append(x)
 
-        def mask_sequence(x, mask, mask_value=tf.float32.min, axis=1):
-            # x: (batch, cont_len)
-            maxlen = x.shape.as_list()[-1]
+        def mask_sequence(x, mask):
+            # x: (batch, cont_len), the logits are masked and normalized in float32
+            x = tf.cast(x, tf.float32)
+            maxlen = tf.shape(x)[-1]
             # mask: (batch, cont_len)
             mask = tf.squeeze(tf.sequence_mask(mask, maxlen=maxlen, dtype=tf.float32), axis=1)
-            return x + mask_value * (1 - mask)
+            return mask_logits(x, mask)
 
         x_start = Concatenate()([outputs[0], outputs[1]])
         x_start = self.start_layer(x_start)
@@ -96,6 +107,11 @@ class QANet:
         return Model(inputs=[ques_input, cont_input], outputs=[x_start, x_end, S_q, S_c])
 
 
+def span_model(model):
+    # shares the weights of a built QANet but only fetches the start/end outputs
+    return Model(inputs=model.inputs, outputs=model.outputs[:2])
+
+
 class DependencyQANet:
     def __init__(self, vocab_size, embed_size, output_size, filters=128, num_heads=1,
                  ques_limit=50, dropout=0.1, num_blocks=1, num_convs=2, embeddings=None,
@@ -138,7 +154,7 @@ class DependencyQANet:
             # x: (batch, seq_len, output_size)
             # mask: (batch, 1)
             mask = tf.transpose(
-                tf.sequence_mask(mask, maxlen=self.ques_limit, dtype=tf.float32),
+                tf.sequence_mask(mask, maxlen=tf.shape(x)[1], dtype=tf.float32),
                 [0, 2, 1])
             # mask: (batch, seq_len, 1)
             return x * mask
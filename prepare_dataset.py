@@ -0,0 +1,30 @@
+from argparse import ArgumentParser
+
+from data import SquadReader, SquadConverter, SquadCache, Vocabulary
+
+from prepare_vocab import PAD_TOKEN, UNK_TOKEN
+
+
+def main(args):
+    token_to_index, _ = Vocabulary.load(args.vocab_file)
+    converter = SquadConverter(token_to_index, PAD_TOKEN, UNK_TOKEN, lower=args.lower,
+                               question_max_len=args.question_max_len,
+                               context_max_len=args.context_max_len)
+    for filename in args.data_path:
+        dataset = SquadReader(filename)
+        cache = SquadCache.build(dataset, converter, SquadCache.path(filename), args.chunk_size)
+        print(f'{filename}: {cache.misaligned} of {len(cache)} answer spans misaligned')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--data-path', nargs='+', type=str,
+                        default=['./data/train-v1.1_filtered_train.txt',
+                                 './data/train-v1.1_filtered_dev.txt'])
+    parser.add_argument('--vocab-file', default='./data/vocab_question_context_min-freq10_max_size.pkl', type=str)
+    parser.add_argument('--question-max-len', default=50, type=int)
+    parser.add_argument('--context-max-len', default=400, type=int)
+    parser.add_argument('--chunk-size', default=1000, type=int)
+    parser.add_argument('--lower', default=False, action='store_true')
+    args = parser.parse_args()
+    main(args)
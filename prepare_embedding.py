@@ -1,26 +1,29 @@
 import os
-import pickle
 from argparse import ArgumentParser
 
 import numpy as np
 
 from data import Vocabulary
-from utils import extract_embeddings, save_word_embedding_as_npy
+from prepare_vocab import PAD_TOKEN, UNK_TOKEN
+from utils import extract_embeddings, save_word_embedding_as_npy, load_word_index
 
 
 def main(args):
     token_to_index, _ = Vocabulary.load(args.vocab_path)
 
-    if os.path.exists(args.embed_array_path) and os.path.exists(args.embed_dict_path):
-        with open(args.embed_dict_path, 'rb') as f:
-            pretrained_token_to_index = pickle.load(f)
-        embeddings = extract_embeddings(token_to_index, pretrained_token_to_index,
-                                        np.load(args.embed_array_path))
+    if os.path.exists(args.embed_array_path) and os.path.exists(args.embed_index_path):
+        pretrained_token_to_index = load_word_index(args.embed_index_path, vocab=token_to_index)
+        pretrained_embeddings = np.load(args.embed_array_path, mmap_mode='r')
+    elif os.path.exists(args.embed_path):
+        pretrained_token_to_index, pretrained_embeddings = save_word_embedding_as_npy(args.embed_path, args.dim)
     else:
-        if os.path.exists(args.embed_path):
-            pretrained_token_to_index, embeddings = save_word_embedding_as_npy(args.embed_path, args.dim)
-        else:
-            raise FileNotFoundError('Please download pre-trained embedding file')
+        raise FileNotFoundError('Please download pre-trained embedding file')
+    # only the vocabulary rows are read from the memory-mapped matrix
+    embeddings, oov_rate = extract_embeddings(
+        token_to_index, pretrained_token_to_index, pretrained_embeddings, args.dim,
+        oov_init=args.oov_init, seed=args.seed, pad_index=token_to_index.get(PAD_TOKEN), return_oov=True,
+        special_indices=[token_to_index[token] for token in (PAD_TOKEN, UNK_TOKEN) if token in token_to_index])
+    print(f'OOV rate: {oov_rate:.2%}')
     root, _ = os.path.splitext(args.vocab_path)
     basepath, basename = os.path.split(root)
     filename = f'{basepath}/embedding_{basename}.npy'
@@ -33,7 +36,10 @@ if __name__ == '__main__':
     parser.add_argument('--embed-path', default='./data/wiki.en.vec', type=str)
     parser.add_argument('--dim', default=300, type=int)
     parser.add_argument('--embed-array-path', default='./data/wiki.en.vec.npy', type=str)
-    parser.add_argument('--embed-dict-path', default='./data/wiki.en.vec.dict', type=str)
+    parser.add_argument('--embed-index-path', '--embed-dict-path',
+                        default='./data/wiki.en.vec.words', type=str)
+    parser.add_argument('--oov-init', default='zeros', choices=['zeros', 'normal', 'mean'])
+    parser.add_argument('--seed', default=None, type=int)
     args = parser.parse_args()
 
     main(args)
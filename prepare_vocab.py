@@ -3,7 +3,7 @@ from argparse import ArgumentParser
 
 import spacy
 
-from data import load_squad_tokens, Vocabulary
+from data import count_squad_tokens, Vocabulary
 
 
 PAD_TOKEN = '<pad>'
@@ -18,23 +18,31 @@ def main(args):
     def tokenizer(x):
         return [postprocess(token.text) for token in spacy_en(x) if not token.is_space]
 
-    if args.only_question:
-        indices = [1]
-        desc = 'question'
+    if args.all:
+        descs = ['question', 'context', 'question_context']
+    elif args.only_question:
+        descs = ['question']
     elif args.only_context:
-        indices = [0]
-        desc = 'context'
+        descs = ['context']
     else:
-        indices = [0, 1]
-        desc = 'question_context'
+        descs = ['question_context']
+
+    # a single pass counts every field that is needed
+    fields = [(field, index) for field, index in (('context', 0), ('question', 1))
+              if any(field in desc for desc in descs)]
+    names, indices = zip(*fields)
+    counters = count_squad_tokens(args.train_path, tokenizer, indices,
+                                  args.chunk_size, args.num_workers)
+    counters = dict(zip(names, counters))
+    if 'question_context' in descs:
+        counters['question_context'] = counters['context'] + counters['question']
 
     basename, ext = os.path.splitext(args.vocab_path)
     min_freq = args.min_freq if args.min_freq else ''
     max_size = args.max_size if args.max_size else ''
-    filename = f'{basename}_{desc}_min-freq{min_freq}_max_size{max_size}{ext}'
-
-    squad_tokens = load_squad_tokens(args.train_path, tokenizer, indices=indices)
-    Vocabulary.build(squad_tokens, args.min_freq, args.max_size, (PAD_TOKEN, UNK_TOKEN), filename)
+    for desc in descs:
+        filename = f'{basename}_{desc}_min-freq{min_freq}_max_size{max_size}{ext}'
+        Vocabulary.build(counters[desc], args.min_freq, args.max_size, (PAD_TOKEN, UNK_TOKEN), filename)
 
 
 if __name__ == '__main__':
@@ -45,7 +53,10 @@ if __name__ == '__main__':
     parser.add_argument('--max-size', default=None, type=int)
     parser.add_argument('--only-question', default=False, action='store_true')
     parser.add_argument('--only-context', default=False, action='store_true')
+    parser.add_argument('--all', default=False, action='store_true')
     parser.add_argument('--lower', default=False, action='store_true')
+    parser.add_argument('--chunk-size', default=1000, type=int)
+    parser.add_argument('--num-workers', default=1, type=int)
     args = parser.parse_args()
 
     main(args)
@@ -1,9 +1,14 @@
+import os
+from tempfile import TemporaryDirectory
 from unittest.mock import patch, mock_open
 from unittest import TestCase
+from collections import Counter
 
 import numpy as np
-from data import make_vocab, load_squad_tokens, SquadReader, Iterator,\
-    SquadConverter, SquadTestConverter, Vocabulary, SquadDepConverter
+from data import make_vocab, load_squad_tokens, count_squad_tokens, encode_tokens, SquadReader, Iterator,\
+    SquadConverter, SquadTestConverter, Vocabulary, SquadDepConverter,\
+    SquadCache, SquadCacheConverter, PrefetchIterator, BucketIterator, bucket_length, Subset,\
+    VocabularyTable
 
 
 class TestData(TestCase):
@@ -34,6 +39,32 @@ class TestData(TestCase):
         open_.assert_called_with(filename)
         patch.stopall()
 
+    def test_make_vocab_from_counter(self):
+        tokens = ['rock', 'n', 'roll', 'rock', 'n', 'rock']
+        self.assertEqual(make_vocab(Counter(tokens), 1, None), make_vocab(tokens, 1, None))
+
+    def test_encode_tokens(self):
+        token_to_index = {'<pad>': 0, '<unk>': 1, 'rock': 2, 'roll': 3}
+        batch = encode_tokens([['rock', 'n', 'roll'], [], ['roll']], 2, token_to_index, 0, 1)
+        expected = np.array([[2, 1], [0, 0], [3, 0]], dtype=np.int32)
+        np.testing.assert_array_equal(batch, expected)
+        self.assertEqual(batch.dtype, np.int32)
+
+    def test_count_squad_tokens(self):
+        read_data = 'a b c d\te f g h i j k\nl m n o p\tq r s t u a\na\tb\n'
+        with TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, 'squad.tsv')
+            with open(filename, 'w') as f:
+                f.write(read_data)
+            expected = [Counter(load_squad_tokens(filename, str.split, [0])),
+                        Counter(load_squad_tokens(filename, str.split, [1]))]
+            counters = count_squad_tokens(filename, str.split, (0, 1), chunk_size=2)
+            self.assertEqual(counters, expected)
+            counters = count_squad_tokens(filename, str.split, (0, 1), chunk_size=1, num_workers=2)
+            self.assertEqual(counters, expected)
+            self.assertEqual(counters[0]['a'], 2)
+            self.assertEqual(counters[1]['a'], 1)
+
 
 class TestVocabulary(TestCase):
     def test_build(self):
@@ -53,32 +84,130 @@ class TestVocabulary(TestCase):
         open_.assert_called_with(filename, mode='rb')
         pickle_load.assert_called_with(open_.return_value)
 
+    def test_build_binary(self):
+        tokens = ['rock', 'n', 'roll', 'rock', 'ünïcode']
+        with TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, 'vocab.vocab')
+            expected, expected_index = Vocabulary.build(tokens, 1, None, ('<pad>', '<unk>'), filename)
+            token_to_index, index_to_token = Vocabulary.load(filename)
+            self.assertIsInstance(token_to_index, VocabularyTable)
+            self.assertEqual(dict(token_to_index), expected)
+            self.assertEqual(list(index_to_token), expected_index)
+
+    def tearDown(self):
+        patch.stopall()
+
+
+class TestVocabularyTable(TestCase):
+    def setUp(self):
+        self.index_to_token = ['<pad>', '<unk>', 'rock', 'n', 'roll', 'rocks']
+        self.tempdir = TemporaryDirectory()
+        filename = os.path.join(self.tempdir.name, 'vocab.vocab')
+        VocabularyTable.save(self.index_to_token, filename)
+        self.table = VocabularyTable(filename)
+
+    def test_mapping(self):
+        self.assertEqual(len(self.table), 6)
+        self.assertEqual(self.table['roll'], 4)
+        self.assertEqual(self.table.get('jazz', 1), 1)
+        self.assertIn('rocks', self.table)
+        self.assertNotIn('roc', self.table)
+        self.assertNotIn('rockstar', self.table)
+        self.assertEqual(list(self.table), self.index_to_token)
+        self.assertEqual(self.table.tokens[3], 'n')
+        self.assertEqual(list(self.table.tokens), self.index_to_token)
+        self.assertEqual(dict(self.table.items()),
+                         {token: i for i, token in enumerate(self.index_to_token)})
+
+    def test_encode(self):
+        batch = self.table.encode([['rock', 'n', 'roll'], ['jazz'], []], 2)
+        expected = np.array([[2, 3], [1, 0], [0, 0]], dtype=np.int32)
+        np.testing.assert_array_equal(batch, expected)
+        self.assertEqual(batch.dtype, np.int32)
+        batch = self.table.encode([['rocks'], ['n', '<pad>', 'rock']])
+        np.testing.assert_array_equal(batch, [[5, 0, 0], [3, 0, 2]])
+        # repeated tokens are searched once and mapped back to every position
+        batch = self.table.encode([['rock', 'jazz', 'rock'], ['jazz', 'roll', 'rock']])
+        np.testing.assert_array_equal(batch, [[2, 1, 2], [1, 4, 2]])
+
+    def test_squad_converter(self):
+        token_to_index = TestSquadConverter.token_to_index
+        filename = os.path.join(self.tempdir.name, 'squad.vocab')
+        VocabularyTable.save(sorted(token_to_index, key=token_to_index.get), filename)
+        converter = SquadConverter(VocabularyTable(filename), '<pad>', '<unk>', True, 5, 12)
+        expected = SquadConverter(token_to_index, '<pad>', '<unk>', True, 5, 12)
+        inputs, outputs = converter(TestSquadConverter.batch)
+        expected_inputs, expected_outputs = expected(TestSquadConverter.batch)
+        for x, y in zip(inputs + outputs, expected_inputs + expected_outputs):
+            np.testing.assert_array_equal(x, y)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
 
 class TestSquadReader(TestCase):
     def setUp(self):
         read_data = 'context1\tquestion1\tstart1\tend1\tanswer1\n' \
             'context2\tquestion2\tstart2\tend2\tanswer2'
-        self.filename = 'path/to/target.tsv'
+        self.tempdir = TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, 'target.tsv')
+        with open(self.filename, 'w') as f:
+            f.write(read_data)
         self.lines = read_data.split('\n')
-        self.mock_open = patch('data.open', mock_open(read_data=read_data)).start()
-        self.mock_getline = patch('data.linecache.getline').start()
         self.dataset = SquadReader(self.filename)
 
     def test_init(self):
         self.assertEqual(self.dataset._filename, self.filename)
         self.assertEqual(self.dataset._total_data, 2)
+        self.assertTrue(os.path.exists(f'{self.filename}.offsets.npy'))
 
     def test_len(self):
         self.assertEqual(len(self.dataset), 2)
 
     def test_getitem(self):
         for i, line in enumerate(self.lines):
-            self.mock_getline.return_value = line
             self.assertListEqual(self.dataset[i], line.split('\t'))
-            self.mock_getline.assert_called_with(self.filename, i + 1)
+        self.assertListEqual(self.dataset[-1], self.lines[-1].split('\t'))
+        with self.assertRaises(IndexError):
+            self.dataset[2]
+
+    def test_getitem_slice(self):
+        rows = [line.split('\t') for line in self.lines]
+        self.assertListEqual(self.dataset[0:2], rows)
+        self.assertListEqual(self.dataset[1:10], rows[1:])
+        self.assertListEqual(self.dataset[::2], rows[::2])
+
+    def test_load_cached_offsets(self):
+        dataset = SquadReader(self.filename)
+        np.testing.assert_array_equal(dataset._offsets, self.dataset._offsets)
+        self.assertListEqual(dataset[1], self.lines[1].split('\t'))
 
     def tearDown(self):
-        patch.stopall()
+        self.tempdir.cleanup()
+
+
+class TestSubset(TestCase):
+    def setUp(self):
+        self.subset = Subset(list(range(10)), 3, 7)
+
+    def test_len(self):
+        self.assertEqual(len(self.subset), 4)
+        self.assertEqual(len(Subset(list(range(10)), 8, 20)), 2)
+        self.assertEqual(len(Subset(list(range(10)), 7, 3)), 0)
+
+    def test_getitem(self):
+        self.assertEqual(self.subset[0], 3)
+        self.assertEqual(self.subset[-1], 6)
+        self.assertEqual(self.subset[1:3], [4, 5])
+        with self.assertRaises(IndexError):
+            self.subset[4]
+
+    def test_take(self):
+        self.assertEqual(self.subset.take([0, 2, 3]), [3, 5, 6])
+
+    def test_iterator(self):
+        generator = Iterator(self.subset, 3, lambda x: x, False, False)
+        self.assertEqual([list(batch) for batch in generator], [[3, 4, 5], [6]])
 
 
 class TestIterator(TestCase):
@@ -133,6 +262,133 @@ class TestIterator(TestCase):
         self.assertEqual(self.generator1.__iter__(), self.generator1)
         self.assertEqual(self.generator2.__iter__(), self.generator2)
 
+    def test_state(self):
+        for _ in range(3):
+            next(self.generator1)
+        state = self.generator1.get_state()
+        # across two reshuffles
+        expected = [list(next(self.generator1)) for _ in range(8)]
+
+        generator = Iterator(self.dataset, self.batch_size, self.converter)
+        generator.set_state(state)
+        self.assertListEqual([list(next(generator)) for _ in range(8)], expected)
+        generator.set_state(state, skip=3)
+        self.assertListEqual([list(next(generator)) for _ in range(5)], expected[3:])
+
+
+class TestBucketIterator(TestCase):
+    def setUp(self):
+        self.dataset = range(100)
+        self.lengths = np.arange(100) % 40
+        self.boundaries = [10, 20, 30]
+        self.batch_size = 8
+
+        def converter(x): return [int(i) for i in x]
+
+        self.generator1 = BucketIterator(
+            self.dataset, self.batch_size, converter, self.lengths, self.boundaries)
+        self.generator2 = BucketIterator(
+            self.dataset, self.batch_size, converter, self.lengths, self.boundaries, False, False)
+
+    def test_len(self):
+        # buckets of 33, 30, 27 and 10 examples
+        self.assertEqual(len(self.generator1), 5 + 4 + 4 + 2)
+        self.assertEqual(len(self.generator2), 5 + 4 + 4 + 2)
+
+    def test_next(self):
+        for _ in range(3 * len(self.generator1)):
+            batch = next(self.generator1)
+            buckets = np.searchsorted(self.boundaries, self.lengths[batch])
+            self.assertEqual(len(set(buckets)), 1)
+
+    def test_state(self):
+        next(self.generator1)
+        state = self.generator1.get_state()
+        expected = [next(self.generator1) for _ in range(2 * len(self.generator1))]
+        generator = BucketIterator(
+            self.dataset, self.batch_size, self.generator1._converter, self.lengths, self.boundaries)
+        generator.set_state(state, skip=1)
+        self.assertListEqual([next(generator) for _ in range(len(expected) - 1)], expected[1:])
+
+    def test_epoch(self):
+        batches = list(self.generator2)
+        self.assertEqual(len(batches), len(self.generator2))
+        self.assertCountEqual(sum(batches, []), list(self.dataset))
+
+    def test_bucket_length(self):
+        self.assertEqual(bucket_length(1, [10, 20], 30), 10)
+        self.assertEqual(bucket_length(10, [10, 20], 30), 10)
+        self.assertEqual(bucket_length(11, [10, 20], 30), 20)
+        self.assertEqual(bucket_length(25, [10, 20], 30), 30)
+        self.assertEqual(bucket_length(15, [10, 20], 12), 12)
+
+
+class TestPrefetchIterator(TestCase):
+    def setUp(self):
+        self.dataset = range(100)
+        self.batch_size = 32
+
+        def converter(x): return [int(i) for i in x]
+
+        self.converter = converter
+
+    def test_next(self):
+        np.random.seed(0)
+        expected = Iterator(self.dataset, self.batch_size, self.converter)
+        expected = [next(expected) for _ in range(10)]
+        np.random.seed(0)
+        iterator = Iterator(self.dataset, self.batch_size, self.converter)
+        with PrefetchIterator(iterator, num_workers=2, prefetch=3) as generator:
+            self.assertEqual(len(generator), 4)
+            self.assertListEqual([next(generator) for _ in range(10)], expected)
+
+    def test_state(self):
+        iterator = Iterator(self.dataset, self.batch_size, self.converter)
+        with PrefetchIterator(iterator, num_workers=2, prefetch=3) as generator:
+            next(generator)
+            # the prefetched batches are not part of the state
+            state = generator.get_state()
+            expected = [next(generator) for _ in range(6)]
+            generator.set_state(state, skip=2)
+            self.assertListEqual([next(generator) for _ in range(4)], expected[2:])
+
+    def test_single_process_converter(self):
+        class Converter:
+            n_process = 2
+
+            def __call__(self, batch):
+                return self.n_process
+
+        converter = Converter()
+        iterator = Iterator(self.dataset, self.batch_size, converter, False, False)
+        with PrefetchIterator(iterator, num_workers=2, prefetch=3) as generator:
+            self.assertListEqual(list(generator), [1] * 4)
+        self.assertEqual(converter.n_process, 2)
+
+    def test_span_counts(self):
+        class Converter:
+            total_spans = misaligned_spans = 0
+
+            def __call__(self, batch):
+                self.total_spans += len(batch)
+                self.misaligned_spans += 1
+                return len(batch)
+
+        converter = Converter()
+        iterator = Iterator(self.dataset, self.batch_size, converter, False, False)
+        with PrefetchIterator(iterator, num_workers=2, prefetch=3) as generator:
+            list(generator)
+        # counted in the workers, gathered in the parent
+        self.assertEqual(converter.total_spans, 100)
+        self.assertEqual(converter.misaligned_spans, 4)
+
+    def test_no_repeat(self):
+        iterator = Iterator(self.dataset, self.batch_size, self.converter, False, False)
+        with PrefetchIterator(iterator, num_workers=2, prefetch=3) as generator:
+            batches = list(generator)
+        self.assertListEqual([len(batch) for batch in batches], [32, 32, 32, 4])
+        self.assertListEqual(sum(batches, []), list(self.dataset))
+
 
 class TestSquadConverter(TestCase):
     batch = [[
@@ -174,6 +430,14 @@ class TestSquadConverter(TestCase):
         context = np.array([[1, 1, 1, 2, 3, 4, 5, 6, 4, 7, 8, 5]], dtype=np.int32)
         np.testing.assert_array_equal(batch, context)
 
+    def test_bucket_padding(self):
+        converter = SquadConverter(
+            self.token_to_index, '<pad>', '<unk>', True, 8, 20, bucket_boundaries=[4, 16])
+        inputs, _ = converter(self.batch)
+        self.assertEqual(inputs[0].shape, (1, 5))
+        self.assertEqual(inputs[1].shape, (1, 16))
+        np.testing.assert_array_equal(inputs[1][0, :12], [1, 1, 1, 2, 3, 4, 5, 6, 4, 7, 8, 5])
+
 
 class TestSquadTestConverter(TestSquadConverter):
     def setUp(self):
@@ -187,7 +451,12 @@ class TestSquadTestConverter(TestSquadConverter):
         self.assertEqual(len(inputs), 2)
         np.testing.assert_array_equal(inputs[0], question)
         np.testing.assert_array_equal(inputs[1], context)
-        self.assertEqual(output, ['ridiculed'])
+        self.assertEqual(output, [['ridiculed']])
+
+    def test_call_multiple_answers(self):
+        batch = [self.batch[0] + ['being ridiculed', 'well-done']]
+        _, output = self.converter(batch)
+        self.assertEqual(output, [['ridiculed', 'being ridiculed', 'well - done']])
 
     def test_get_valid_tokenized_answers(self):
         answer = 'well-done'
@@ -221,3 +490,73 @@ class TestSquadDepConverter(TestSquadConverter):
             [deps], 5, self.converter._dep_to_index, self.converter._unk_dep)
         expected = np.array([[6, 50, 42, 31, 47]], dtype=np.int32)
         np.testing.assert_array_equal(batch, expected)
+
+
+class TestSquadCache(TestCase):
+    batch = TestSquadConverter.batch + [[
+        'You risk being ridiculed.',
+        'What is a risk?',
+        15, 24,
+        'ridiculed'
+    ]]
+
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        filename = os.path.join(self.tempdir.name, 'target.tsv')
+        with open(filename, 'w') as f:
+            for row in self.batch:
+                f.write('\t'.join(str(x) for x in row) + '\n')
+        self.dataset = SquadReader(filename)
+        self.converter = SquadConverter(
+            TestSquadConverter.token_to_index, '<pad>', '<unk>', True, 5, 12)
+        self.cache = SquadCache.build(
+            self.dataset, self.converter, SquadCache.path(filename), chunk_size=1)
+
+    def test_build(self):
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.meta['context_max_len'], 12)
+        self.assertEqual(self.cache.meta['question_max_len'], 5)
+        context, question, context_length, question_length, offsets, span = self.cache[1]
+        self.assertEqual(context_length, 5)
+        self.assertEqual(question_length, 5)
+        np.testing.assert_array_equal(offsets[:2], [[0, 3], [4, 8]])
+        np.testing.assert_array_equal(span, [3, 3])
+        self.assertEqual(self.cache.misaligned, 0)
+
+    def test_check(self):
+        self.cache.check(len(TestSquadConverter.token_to_index), 12, 5)
+        with self.assertRaisesRegex(ValueError, 'vocab_size is'):
+            self.cache.check(len(TestSquadConverter.token_to_index) + 1, 12, 5)
+        with self.assertRaisesRegex(ValueError, 'context_max_len is 12, expected 400'):
+            self.cache.check(len(TestSquadConverter.token_to_index), 400, 5)
+        reloaded = SquadCache(self.cache._dirname)
+        with self.assertRaisesRegex(ValueError, 'question_max_len'):
+            reloaded.check(len(TestSquadConverter.token_to_index), 12, 50)
+
+    def test_misaligned(self):
+        filename = os.path.join(self.tempdir.name, 'misaligned.tsv')
+        with open(filename, 'w') as f:
+            f.write('You risk being ridiculed.\tWhat is a risk?\t16\t24\tidiculed\n')
+        cache = SquadCache.build(SquadReader(filename), self.converter, SquadCache.path(filename))
+        self.assertEqual(cache.misaligned, 1)
+        np.testing.assert_array_equal(cache[0][-1], [3, 3])
+
+        self.converter(self.batch)
+        self.converter(SquadReader(filename)[0:1])
+        self.assertEqual(self.converter.total_spans, 3)
+        self.assertEqual(self.converter.misaligned_spans, 1)
+
+    def test_bucket_padding(self):
+        inputs, _ = SquadCacheConverter(bucket_boundaries=[4, 8])(self.cache.take(np.array([1])))
+        self.assertEqual(inputs[0].shape, (1, 5))
+        self.assertEqual(inputs[1].shape, (1, 8))
+        np.testing.assert_array_equal(inputs[1][0, 5:], [0, 0, 0])
+
+    def test_converter(self):
+        inputs, outputs = SquadCacheConverter()(self.cache.take(np.array([1, 0])))
+        expected_inputs, expected_outputs = self.converter(self.batch[::-1])
+        for x, y in zip(inputs + outputs, expected_inputs + expected_outputs):
+            np.testing.assert_array_equal(x, y)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
@@ -2,9 +2,10 @@ from unittest import TestCase
 
 import tensorflow as tf
 import numpy as np
+from keras import backend as K
 
 from layers import PositionEmbedding, MultiHeadAttention, ContextQueryAttention,\
-    LayerDropout
+    LayerDropout, AttentionMask, mask_logits
 
 
 class TestPositionEmbedding(TestCase):
@@ -35,6 +36,60 @@ class TestMultiHeadAttention(TestCase):
         self.assertEqual(hidden_size, 128)
 
 
+class TestFusedMultiHeadAttention(TestCase):
+    def test_call(self):
+        attn = MultiHeadAttention(16, 2, 'glorot_uniform', None, 0.)
+        x = tf.constant(np.random.randn(2, 10, 16).astype(np.float32))
+        seq_len = tf.constant(np.array([[10], [4]], dtype=np.int32))
+        mask = AttentionMask()([x, seq_len])
+
+        def conv_ops():
+            return sum(op.type.startswith('Conv') for op in tf.get_default_graph().get_operations())
+
+        # self-attention runs one projection for Q, K and V, plus the output projection
+        count = conv_ops()
+        fused = attn([x, x, x] + mask)
+        self.assertEqual(conv_ops() - count, 2)
+        count = conv_ops()
+        separate = attn([x, tf.identity(x), tf.identity(x), seq_len])
+        self.assertEqual(conv_ops() - count, 4)
+        fused, separate = K.get_session().run([fused, separate])
+        self.assertEqual(fused.shape, (2, 10, 16))
+        np.testing.assert_allclose(fused, separate, rtol=1e-5, atol=1e-5)
+        # padded query positions do not attend
+        np.testing.assert_array_equal(fused[1, 4:], 0)
+
+
+class TestHalfPrecisionMultiHeadAttention(TestCase):
+    def test_call(self):
+        attn = MultiHeadAttention(16, 2, 'glorot_uniform', None, 0.)
+        x = np.random.randn(2, 10, 16).astype(np.float32)
+        seq_len = tf.constant(np.array([[10], [4]], dtype=np.int32))
+        x32 = tf.constant(x)
+        x16 = tf.constant(x.astype(np.float16))
+        outputs32 = attn([x32, x32, x32] + AttentionMask()([x32, seq_len]))
+        outputs16 = attn([x16, x16, x16] + AttentionMask()([x16, seq_len]))
+        self.assertEqual(outputs16.dtype, tf.float16)
+        self.assertEqual(attn.W_Q.dtype.base_dtype, tf.float32)
+        outputs32, outputs16 = K.get_session().run([outputs32, outputs16])
+        self.assertTrue(np.isfinite(outputs16).all())
+        np.testing.assert_allclose(outputs16, outputs32, rtol=5e-2, atol=5e-2)
+        np.testing.assert_array_equal(outputs16[1, 4:], 0)
+
+
+class TestMaskLogits(TestCase):
+    def test_call(self):
+        mask = tf.constant([[1., 1., 0.]])
+        for dtype in (tf.float32, tf.float16):
+            x = tf.constant([[1., -60000., 60000.]], dtype=dtype)
+            masked = mask_logits(x, mask)
+            weights = tf.nn.softmax(tf.cast(masked, tf.float32))
+            masked, weights = K.get_session().run([masked, weights])
+            self.assertTrue(np.isfinite(masked).all())
+            self.assertEqual(masked[0, 2], dtype.min)
+            np.testing.assert_allclose(weights, [[1., 0., 0.]])
+
+
 class TestContextQueryAttention(TestCase):
     def setUp(self):
         self.attn = ContextQueryAttention(128, 400, 50)
@@ -50,6 +105,20 @@ class TestContextQueryAttention(TestCase):
         self.assertEqual(hidden_size, 128 * 4)
 
 
+class TestContextQueryAttentionSimilarity(TestCase):
+    def test_similarity(self):
+        attn = ContextQueryAttention(40, 5, 'glorot_uniform', None, 0.)
+        context = tf.constant(np.random.randn(2, 40, 16).astype(np.float32))
+        query = tf.constant(np.random.randn(2, 5, 16).astype(np.float32))
+        seq_len = tf.constant(np.array([[40], [20]], dtype=np.int32))
+        attn([context, query, seq_len, seq_len])
+        sess = K.get_session()
+        S, S_tiled = sess.run([attn.similarity(context, query),
+                               attn.tiled_similarity(context, query)])
+        self.assertEqual(S.shape, (2, 40, 5))
+        np.testing.assert_allclose(S, S_tiled, rtol=1e-4, atol=1e-4)
+
+
 class TestLayerDropout(TestCase):
     def setUp(self):
         self.ratio = 0.2
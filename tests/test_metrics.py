@@ -1,5 +1,7 @@
+import pickle
 from unittest import TestCase
-from metrics import normalize_answer, f1_score, exact_match_score, metric_max_over_ground_truths, SquadMetric
+from metrics import normalize_answer, f1_score, exact_match_score, metric_max_over_ground_truths, SquadMetric, \
+    prepare_ground_truth
 
 
 class TestNormalizeAnswer(TestCase):
@@ -27,6 +29,15 @@ class TestExactMatchScore(TestCase):
         self.assertEqual(exact_match_score(ground_truth, ground_truth), 1)
 
 
+class TestPrepareGroundTruth(TestCase):
+    def test_prepare_ground_truth(self):
+        ground_truth = prepare_ground_truth('   Rock    n  Roll.')
+        self.assertEqual(ground_truth.text, '   Rock    n  Roll.')
+        self.assertEqual(ground_truth.normalized, 'rock n roll')
+        self.assertEqual(ground_truth.tokens, {'rock': 1, 'n': 1, 'roll': 1})
+        self.assertEqual(ground_truth.length, 3)
+
+
 class TestMetricMaxOverGroundTruths(TestCase):
     def test_metric_max_over_ground_truths(self):
         prediction = 'rock'
@@ -71,3 +82,48 @@ class TestSquadMetric(TestCase):
         metric = self.metric.get_metric()
         self.assertEqual(metric[0], 1 / 2)
         self.assertEqual(metric[1], (f1 + 1) / 2)
+
+    def test_update(self):
+        predictions = ['rock', 'rock n roll', 'Rock N Roll!', 'jazz']
+        ground_truths = ['rock n roll', 'rock n roll', 'rock n roll', 'rock n roll']
+        self.metric.prepare(set(ground_truths))
+        self.metric.update(predictions, ground_truths)
+
+        expected = SquadMetric()
+        for prediction, ground_truth in zip(predictions, ground_truths):
+            expected(prediction, ground_truth)
+        self.assertEqual(self.metric._count, 4)
+        self.assertEqual(self.metric._total_em, 2)
+        self.assertEqual(self.metric.get_metric(), expected.get_metric())
+
+    def test_reset_keeps_ground_truths(self):
+        self.metric('rock', 'rock n roll')
+        self.metric.get_metric(reset=True)
+        self.assertEqual(self.metric._count, 0)
+        self.assertIn('rock n roll', self.metric._ground_truths)
+
+    def test_multiple_answers(self):
+        self.metric.update(['rock', 'Jazz!'], [['rock n roll', 'rock'], ('blues', 'jazz')])
+        self.metric('roll', ['rock n roll', 'rock'])
+        f1 = (2 * 1. * (1 / 3)) / (1. + 1 / 3)
+        self.assertEqual(self.metric._count, 3)
+        self.assertEqual(self.metric._total_em, 2)
+        self.assertEqual(self.metric._total_f1, 2 + f1)
+
+    def test_merge(self):
+        predictions = ['rock', 'rock n roll', 'Rock N Roll!', 'jazz']
+        ground_truths = ['rock n roll'] * 4
+        self.metric.update(predictions, ground_truths)
+        first, second = SquadMetric(), SquadMetric()
+        first.update(predictions[:1], ground_truths[:1])
+        second.update(predictions[1:], ground_truths[1:])
+        merged = SquadMetric().merge(first).merge(second)
+        self.assertEqual(merged._count, 4)
+        self.assertAlmostEqual(merged.get_metric()[0], self.metric.get_metric()[0])
+        self.assertAlmostEqual(merged.get_metric()[1], self.metric.get_metric()[1])
+
+    def test_pickle_drops_ground_truths(self):
+        self.metric('rock', 'rock n roll')
+        metric = pickle.loads(pickle.dumps(self.metric))
+        self.assertEqual(metric._ground_truths, {})
+        self.assertEqual(metric.get_metric(), self.metric.get_metric())
@@ -1,7 +1,10 @@
 from unittest import TestCase
 
+import numpy as np
+
 from keras import backend as K
-from models import QANet
+from models import QANet, span_model
+from layers import LayerNormalization, PositionEmbedding
 
 
 class TestQANet(TestCase):
@@ -22,3 +25,53 @@ class TestQANet(TestCase):
         self.assertTupleEqual(K.int_shape(context_input), (None, context_limit))
         self.assertTupleEqual(K.int_shape(start_prob), (None, context_limit))
         self.assertTupleEqual(K.int_shape(end_prob), (None, context_limit))
+
+    def test_build_variable_length(self):
+        model = QANet(3000, 96, 96, 1, encoder_num_blocks=1, encoder_num_convs=2,
+                      output_num_blocks=2, output_num_convs=2,
+                      cont_limit=None, ques_limit=None).build()
+        query_input, context_input = model.inputs
+        start_prob, end_prob, S_q, S_c = model.outputs
+
+        self.assertTupleEqual(K.int_shape(query_input), (None, None))
+        self.assertTupleEqual(K.int_shape(context_input), (None, None))
+        self.assertTupleEqual(K.int_shape(start_prob), (None, None))
+
+        for context_len in (40, 80):
+            question = np.random.randint(1, 3000, (2, 5))
+            context = np.random.randint(1, 3000, (2, context_len))
+            start, end, S_q, S_c = model.predict_on_batch([question, context])
+            self.assertTupleEqual(start.shape, (2, context_len))
+            self.assertTupleEqual(S_q.shape, (2, context_len, 5))
+
+    def test_build_reuses_encoder_layers(self):
+        model = QANet(3000, 96, 96, 1, encoder_num_blocks=1, encoder_num_convs=4,
+                      output_num_blocks=7, output_num_convs=2, cont_limit=40, ques_limit=5).build()
+        norm_layers = [layer for layer in model.layers if isinstance(layer, LayerNormalization)]
+        position_layers = [layer for layer in model.layers if isinstance(layer, PositionEmbedding)]
+        # one set of layers per encoder, shared by every application
+        self.assertEqual(len(norm_layers), 1 * (4 + 2) + 7 * (2 + 2))
+        self.assertEqual(len(position_layers), 2)
+
+    def test_span_model(self):
+        model = QANet(3000, 96, 96, 1, encoder_num_blocks=1, encoder_num_convs=2,
+                      output_num_blocks=1, output_num_convs=2, cont_limit=40, ques_limit=5).build()
+        fast_model = span_model(model)
+        self.assertEqual(len(fast_model.outputs), 2)
+        self.assertEqual(len(fast_model.weights), len(model.weights))
+
+    def test_build_float16(self):
+        model = QANet(3000, 96, 96, 1, encoder_num_blocks=1, encoder_num_convs=2,
+                      output_num_blocks=1, output_num_convs=2, cont_limit=40, ques_limit=5,
+                      compute_dtype='float16').build()
+        start_prob, end_prob, S_q, S_c = model.outputs
+        self.assertEqual(start_prob.dtype.base_dtype, 'float32')
+        self.assertTrue(all(weight.dtype.base_dtype == 'float32' for weight in model.weights))
+
+        question = np.random.randint(1, 3000, (2, 5))
+        context = np.random.randint(1, 3000, (2, 40))
+        context[1, 20:] = 0
+        start, end, S_q, S_c = model.predict_on_batch([question, context])
+        self.assertTrue(np.isfinite(start).all())
+        np.testing.assert_allclose(start.sum(axis=1), 1., rtol=1e-5)
+        np.testing.assert_array_equal(start[1, 20:], 0)
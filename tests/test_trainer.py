@@ -1,7 +1,21 @@
+import os
+import ast
+import glob
+import tempfile
 from unittest import TestCase
 from unittest.mock import MagicMock
 
-from trainer import SquadTrainer
+import numpy as np
+from keras import backend as K
+from keras.models import Sequential
+from keras.layers import Dense
+from keras.optimizers import Adam
+
+from keras.callbacks import LambdaCallback, History
+
+from data import Iterator
+from trainer import SquadTrainer, AccumulatingAdam, BatchLearningRateScheduler, \
+    ExponentialMovingAverage, TrainingCheckpoint, MisalignedSpanLogger
 
 
 class TestSquadTrainer(TestCase):
@@ -25,4 +39,237 @@ class TestSquadTrainer(TestCase):
         self.mock_model.fit_generator.assert_called_with(
             generator=self.mock_generator, epochs=epoch, validation_data=self.mock_generator,
             steps_per_epoch=len(self.mock_generator), validation_steps=len(self.mock_generator),
-            callbacks=trainer.callbacks)
+            callbacks=trainer.callbacks, initial_epoch=0)
+
+        trainer.run(3)
+        self.assertEqual(self.mock_model.fit_generator.call_args[1]['initial_epoch'], 3)
+
+    def test_run_mid_epoch(self):
+        self.mock_generator.__len__.return_value = 10
+        partial, rest = History(), History()
+        partial.epoch, partial.history = [3], {'loss': [1.]}
+        rest.epoch, rest.history = [4, 5], {'loss': [.5, .25]}
+        self.mock_model.fit_generator.side_effect = [partial, rest]
+        trainer = SquadTrainer(self.mock_model, self.mock_generator, 6,
+                               self.mock_generator, '/path/to/save')
+
+        history = trainer.run(3, 4)
+        first, second = [kwargs for _, kwargs in self.mock_model.fit_generator.call_args_list]
+        # the rest of the interrupted epoch, then whole epochs
+        self.assertEqual((first['initial_epoch'], first['epochs'], first['steps_per_epoch']), (3, 4, 6))
+        self.assertEqual(first['workers'], 0)
+        self.assertEqual((second['initial_epoch'], second['epochs'], second['steps_per_epoch']), (4, 6, 10))
+        self.assertEqual(history.epoch, [3, 4, 5])
+        self.assertEqual(history.history['loss'], [1., .5, .25])
+
+
+def linear_model(optimizer):
+    model = Sequential([Dense(1, input_shape=(3,), kernel_initializer='ones')])
+    model.compile(optimizer=optimizer, loss='mse')
+    return model
+
+
+class TestAccumulatingAdam(TestCase):
+    def setUp(self):
+        self.x = np.random.randn(8, 3).astype(np.float32)
+        self.y = np.random.randn(8, 1).astype(np.float32)
+
+    def test_matches_full_batch(self):
+        full = linear_model(Adam(lr=0.1, clipnorm=1.))
+        accumulated = linear_model(AccumulatingAdam(accumulation_steps=4, lr=0.1, clipnorm=1.))
+        for _ in range(2):
+            full.train_on_batch(self.x, self.y)
+            for i in range(0, 8, 2):
+                accumulated.train_on_batch(self.x[i:i + 2], self.y[i:i + 2])
+        for expected, actual in zip(full.get_weights(), accumulated.get_weights()):
+            np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+        self.assertEqual(K.get_value(accumulated.optimizer.iterations), 2)
+
+    def test_weights_change_once_per_step(self):
+        model = linear_model(AccumulatingAdam(accumulation_steps=2, lr=0.1))
+        initial = model.get_weights()
+        model.train_on_batch(self.x[:4], self.y[:4])
+        for expected, actual in zip(initial, model.get_weights()):
+            np.testing.assert_array_equal(actual, expected)
+        model.train_on_batch(self.x[4:], self.y[4:])
+        self.assertFalse(np.array_equal(model.get_weights()[0], initial[0]))
+
+
+class TestBatchLearningRateScheduler(TestCase):
+    def test_counts_optimizer_steps(self):
+        model = linear_model(AccumulatingAdam(accumulation_steps=3, lr=0.1))
+        scheduler = BatchLearningRateScheduler()
+        model.fit(np.zeros((12, 3)), np.zeros((12, 1)), batch_size=1, epochs=1,
+                  callbacks=[scheduler], verbose=0)
+        self.assertEqual(scheduler.global_step, 12 // 3 + 1)
+
+
+class TestExponentialMovingAverage(TestCase):
+    def average(self, optimizer, how='fit', batches=6):
+        model = linear_model(optimizer)
+        ema = ExponentialMovingAverage(0.5).attach(model)
+        # the numpy average, updated whenever the optimizer has changed the weights
+        state = {'previous': model.get_weights(), 'expected': model.get_weights()}
+
+        def record(batch, logs):
+            weights = model.get_weights()
+            if not all(np.array_equal(w, p) for w, p in zip(weights, state['previous'])):
+                state['expected'] = [0.5 * e + 0.5 * w for e, w in zip(state['expected'], weights)]
+            state['previous'] = weights
+
+        x, y = np.random.randn(batches, 3), np.random.randn(batches, 1)
+        callbacks = [ema, LambdaCallback(on_batch_end=record)]
+        if how == 'fit':
+            model.fit(x, y, batch_size=1, epochs=1, callbacks=callbacks, verbose=0)
+        elif how == 'fit_generator':
+            generator = ((x[i:i + 1], y[i:i + 1]) for i in range(batches))
+            model.fit_generator(generator, steps_per_epoch=len(x), epochs=1, callbacks=callbacks,
+                                verbose=0, workers=0)
+        else:
+            ema.on_train_begin()
+            for i in range(batches):
+                model.train_on_batch(x[i:i + 1], y[i:i + 1])
+                record(i, {})
+            ema.on_epoch_end(0)
+        self.assertFalse(np.array_equal(state['expected'][0], np.ones((3, 1))))
+        return model, ema, state['expected']
+
+    def test_average(self):
+        for how in ('fit', 'fit_generator', 'train_on_batch'):
+            model, ema, expected = self.average(Adam(lr=0.1), how)
+            self.assertIs(model.train_function, ema.train_function)
+            # the averages are assigned to the weights at the end of the epoch
+            for e, actual in zip(expected, model.get_weights()):
+                np.testing.assert_allclose(actual, e, rtol=1e-5, atol=1e-6)
+
+    def test_average_accumulated(self):
+        for how in ('fit', 'fit_generator'):
+            model, ema, expected = self.average(AccumulatingAdam(accumulation_steps=3, lr=0.1), how)
+            for e, actual in zip(expected, model.get_weights()):
+                np.testing.assert_allclose(actual, e, rtol=1e-5, atol=1e-6)
+
+    def test_not_attached(self):
+        model = linear_model(Adam(lr=0.1))
+        with self.assertRaises(RuntimeError):
+            model.fit(np.zeros((2, 3)), np.zeros((2, 1)), callbacks=[ExponentialMovingAverage()],
+                      verbose=0)
+
+
+class TestEntryPoints(TestCase):
+    def test_ema_is_attached(self):
+        # every script building the callback attaches it, or training fails in on_train_begin
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        scripts = 0
+        for filename in glob.glob(os.path.join(root, '*.py')):
+            with open(filename) as f:
+                tree = ast.parse(f.read())
+            attached = {id(node.func.value) for node in ast.walk(tree)
+                        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                        and node.func.attr == 'attach'}
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'ExponentialMovingAverage':
+                    scripts += 1
+                    self.assertIn(id(node), attached, f'{filename}:{node.lineno}')
+        self.assertGreaterEqual(scripts, 2)
+
+
+class TestMisalignedSpanLogger(TestCase):
+    def test_on_epoch_end(self):
+        converter = MagicMock(total_spans=10, misaligned_spans=1)
+        logger = MisalignedSpanLogger(converter)
+        logger.on_epoch_begin(1)
+        converter.total_spans, converter.misaligned_spans = 30, 4
+        logs = {}
+        logger.on_epoch_end(1, logs)
+        self.assertEqual(logs['misaligned_spans'], 3)
+
+    def test_fit_generator(self):
+        # validation batches go through a converter of their own and are not counted
+        x = np.random.randn(8, 3).astype(np.float32)
+        y = np.random.randn(8, 1).astype(np.float32)
+
+        class Converter:
+            total_spans = misaligned_spans = 0
+
+            def __call__(self, batch):
+                self.total_spans += len(batch)
+                self.misaligned_spans += 1
+                return x[batch], y[batch]
+
+        converter = Converter()
+        model = linear_model(Adam())
+        history = model.fit_generator(
+            Iterator(list(range(8)), 4, converter), steps_per_epoch=2, epochs=2,
+            validation_data=Iterator(list(range(8)), 4, Converter()), validation_steps=2,
+            callbacks=[MisalignedSpanLogger(converter)], workers=0)
+        self.assertEqual(history.history['misaligned_spans'], [2, 2])
+        self.assertEqual(converter.total_spans, 16)
+
+
+class TestTrainingCheckpoint(TestCase):
+    def setUp(self):
+        self.x = np.random.randn(20, 3).astype(np.float32)
+        self.y = np.random.randn(20, 1).astype(np.float32)
+
+    def converter(self, batch):
+        return self.x[batch], self.y[batch]
+
+    def iterator(self):
+        np.random.seed(0)
+        return Iterator(list(range(20)), 4, self.converter)
+
+    def test_restore(self):
+        model = linear_model(AccumulatingAdam(accumulation_steps=2, lr=0.1))
+        ema = ExponentialMovingAverage(0.5).attach(model)
+        iterator = self.iterator()
+        with tempfile.TemporaryDirectory() as dirname:
+            filepath = os.path.join(dirname, 'checkpoint.pkl')
+            checkpoint = TrainingCheckpoint(filepath, iterator, ema, period=3)
+            model.fit_generator(iterator, steps_per_epoch=7, epochs=1,
+                                callbacks=[ema, checkpoint], verbose=0)
+            self.assertFalse(os.path.exists(f'{filepath}.tmp'))
+
+            restored_model = linear_model(AccumulatingAdam(accumulation_steps=2, lr=0.1))
+            restored_ema = ExponentialMovingAverage(0.5)
+            restored_iterator = self.iterator()
+            restored = TrainingCheckpoint(filepath, restored_iterator, restored_ema)
+            self.assertEqual(restored.restore(restored_model), (1, 0))
+            self.assertEqual(restored.initial_batch, 0)
+
+        for expected, actual in zip(model.get_weights(), restored_model.get_weights()):
+            np.testing.assert_array_equal(actual, expected)
+        for expected, actual in zip(model.optimizer.get_weights(),
+                                    restored_model.optimizer.get_weights()):
+            np.testing.assert_array_equal(actual, expected)
+        for expected, actual in zip(K.batch_get_value(ema.shadows), restored_ema.initial_averages):
+            np.testing.assert_array_equal(actual, expected)
+        # the iterator goes on after the 7 batches trained on, not the ones Keras read ahead
+        expected_iterator = self.iterator()
+        for _ in range(7):
+            next(expected_iterator)
+        np.testing.assert_array_equal(next(restored_iterator)[0], next(expected_iterator)[0])
+
+    def test_restore_mid_epoch(self):
+        model = linear_model(Adam(lr=0.1))
+        iterator = self.iterator()
+
+        def preempt(batch, logs):
+            if batch == 4:
+                raise KeyboardInterrupt
+
+        with tempfile.TemporaryDirectory() as dirname:
+            filepath = os.path.join(dirname, 'checkpoint.pkl')
+            checkpoint = TrainingCheckpoint(filepath, iterator, period=3)
+            with self.assertRaises(KeyboardInterrupt):
+                model.fit_generator(iterator, steps_per_epoch=7, epochs=1, verbose=0,
+                                    callbacks=[checkpoint, LambdaCallback(on_batch_end=preempt)])
+
+            restored_iterator = self.iterator()
+            restored = TrainingCheckpoint(filepath, restored_iterator)
+            # saved after the third batch of the first epoch
+            self.assertEqual(restored.restore(linear_model(Adam(lr=0.1))), (0, 3))
+
+        expected_iterator = self.iterator()
+        for _ in range(3):
+            next(expected_iterator)
+        np.testing.assert_array_equal(next(restored_iterator)[0], next(expected_iterator)[0])
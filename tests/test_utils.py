@@ -1,7 +1,15 @@
 from unittest import TestCase
 from unittest.mock import MagicMock, Mock, patch, mock_open, call
-from utils import char_span_to_token_span, get_spans, evaluate, filter_dataset, \
-    make_small_dataset, split_dataset
+import os
+import csv
+import json
+import pickle
+import tempfile
+import numpy as np
+
+from utils import char_span_to_token_span, align_spans, get_spans, evaluate, filter_dataset, \
+    make_small_dataset, split_dataset, decode_spans, span_band, visualize_attention, convert_squad_json, \
+    save_word_embedding_as_npy, load_word_embedding, load_word_index, extract_embeddings
 
 
 class TestUitls(TestCase):
@@ -15,6 +23,29 @@ class TestUitls(TestCase):
         self.assertEqual(error, False)
         self.assertEqual(span, (0, 2))
 
+        span, error = char_span_to_token_span(token_offsets, 28, 37)
+        self.assertEqual(error, True)
+        self.assertEqual(span, (8, 9))
+        span, error = char_span_to_token_span(token_offsets, -1, -1)
+        self.assertEqual(error, False)
+        self.assertEqual(span, (-1, -1))
+
+    def test_align_spans(self):
+        token_offsets = np.zeros((3, 4, 2), dtype=np.int64)
+        token_offsets[0] = [(0, 4), (5, 6), (7, 11), (12, 14)]
+        token_offsets[1, :2] = [(0, 3), (3, 5)]
+        token_offsets[2, :3] = [(0, 2), (3, 8), (9, 10)]
+        char_starts = [5, 3, 4]
+        char_ends = [11, 5, 8]
+        spans, errors = align_spans(token_offsets, [4, 2, 3], char_starts, char_ends)
+        np.testing.assert_array_equal(spans, [[1, 2], [1, 1], [1, 1]])
+        np.testing.assert_array_equal(errors, [False, False, True])
+        for i, length in enumerate([4, 2, 3]):
+            span, error = char_span_to_token_span(
+                token_offsets[i, :length].tolist(), char_starts[i], char_ends[i])
+            self.assertEqual(span, tuple(spans[i]))
+            self.assertEqual(error, errors[i])
+
     def test_get_spans(self):
         import spacy
         spacy_en = spacy.load(
@@ -25,6 +56,10 @@ class TestUitls(TestCase):
 
         self.assertEqual(spans[0], (0, 2))
 
+        spans, errors = get_spans(contexts * 2, [0, 1], [11, 11], return_errors=True)
+        self.assertEqual(spans, [(0, 2), (0, 2)])
+        np.testing.assert_array_equal(errors, [False, True])
+
     def test_evaluate(self):
         from metrics import SquadMetric
         import numpy as np
@@ -42,13 +77,55 @@ class TestUitls(TestCase):
         question = np.array([[6, 7, 8]])
         answer = ['world cup']
         test_generator.__iter__.return_value = iter([[[question, context], answer]])
-        index_to_token = {2: 'world', 3: 'cup'}
+        index_to_token = {1: 'the', 2: 'world', 3: 'cup', 4: 'in', 5: 'russia',
+                          6: 'which', 7: 'tournament', 8: '?'}
 
         em_score, f1_score = evaluate(model, test_generator, metric, index_to_token, 3)
         self.assertEqual(em_score, 1.)
         self.assertEqual(f1_score, 1.)
         model.predict_on_batch.assert_called_with([question, context])
-        mock_visualize.stop()
+        mock_visualize.assert_not_called()
+        patch.stopall()
+
+    def test_visualize_attention(self):
+        model = Mock()
+        S_bar = np.random.randn(2, 5, 3)
+        S_T = np.random.randn(2, 5, 3)
+        model.configure_mock(**{'predict_on_batch.return_value': [None, None, S_bar, S_T]})
+        mock_visualize = patch('utils.visualize').start()
+        context = np.array([[1, 2, 3, 0, 0], [1, 2, 3, 4, 5]])
+        question = np.array([[6, 7, 0], [6, 7, 8]])
+        converter = Mock(return_value=([question, context], ['world cup', 'russia']))
+        dataset = ['row0', 'row1', 'row2', 'row3']
+        index_to_token = {1: 'the', 2: 'world', 3: 'cup', 4: 'in', 5: 'russia',
+                          6: 'which', 7: 'tournament', 8: '?'}
+
+        visualize_attention(model, dataset, converter, [3, 1], index_to_token)
+        converter.assert_called_once_with(['row3', 'row1'])
+        self.assertEqual(mock_visualize.call_count, 2)
+        args = mock_visualize.call_args_list[0][0]
+        self.assertListEqual(args[0], ['which', 'tournament'])
+        self.assertListEqual(args[1], ['the', 'world', 'cup'])
+        self.assertEqual(args[4], 'attention_3.png')
+        patch.stopall()
+
+    def test_decode_spans(self):
+        start_prob = np.array([[.1, .6, .1, .1, .1],
+                               [.5, .1, .1, .1, .2]], dtype=np.float32)
+        end_prob = np.array([[.05, .05, .2, .1, .6],
+                             [.1, .1, .2, .5, .1]], dtype=np.float32)
+        starts, ends = decode_spans(start_prob, end_prob, answer_limit=2)
+        # spans longer than answer_limit or ending before their start are ignored
+        np.testing.assert_array_equal(starts, [1, 0])
+        np.testing.assert_array_equal(ends, [2, 2])
+        starts, ends = decode_spans(start_prob, end_prob, answer_limit=4)
+        np.testing.assert_array_equal(starts, [1, 0])
+        np.testing.assert_array_equal(ends, [4, 3])
+
+    def test_span_band_cache_is_bounded(self):
+        for length in range(1, 100):
+            decode_spans(np.ones((1, length)), np.ones((1, length)))
+        self.assertLessEqual(span_band.cache_info().currsize, 32)
 
     def test_filter_dataset(self):
         filename = '/path/to/dataset.tsv'
@@ -58,39 +135,169 @@ class TestUitls(TestCase):
         open_ = patch('utils.open', mock_open(read_data=read_data)).start()
         open_.return_value.__iter__.return_value = read_data.split('\n')
         writer = patch('csv.writer').start()
+        save = patch('utils.np.save').start()
         filter_dataset(filename, 5, 7)
         open_.assert_has_calls([call(filename), call(dest_path, 'w')], any_order=True)
         writer.assert_called_once_with(open_.return_value, delimiter='\t')
         writer.return_value.writerow.assert_called_once_with(read_data.split('\n')[1].split('\t'))
+        save.assert_called_once()
+        self.assertEqual(save.call_args[0][0], f'{dest_path}.lengths.npy')
+        np.testing.assert_array_equal(save.call_args[0][1], [[7, 5]])
         patch.stopall()
 
+    def test_filter_dataset_workers(self):
+        rows = [['Rock n Roll is a risk. You rick being ridiculed.', 'Do you like rock music?'],
+                ['Rock n Roll is a risk.', 'Do you like rock?'],
+                ['You risk being ridiculed.', 'Is it a risk?']]
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, 'dataset.tsv')
+            with open(filename, 'w') as f:
+                csv.writer(f, delimiter='\t').writerows(rows)
+            dest_path = filter_dataset(filename, 5, 7, num_workers=2, chunk_size=1)
+            with open(dest_path) as f:
+                self.assertEqual(list(csv.reader(f, delimiter='\t')), rows[1:])
+            lengths = np.load(f'{dest_path}.lengths.npy')
+        np.testing.assert_array_equal(lengths, [[7, 5], [5, 5]])
+
+    def write_dataset(self, dirname, size=10):
+        filename = os.path.join(dirname, 'dataset.tsv')
+        rows = [[f'context {i}', f'question {i}', str(i), str(i + 1), f'answer {i}']
+                for i in range(size)]
+        with open(filename, 'w') as f:
+            csv.writer(f, delimiter='\t').writerows(rows)
+        np.save(f'{filename}.lengths.npy', np.arange(size * 2, dtype=np.int32).reshape(size, 2))
+        return filename, rows
+
+    def read_dataset(self, filename):
+        with open(filename) as f:
+            return list(csv.reader(f, delimiter='\t'))
+
     def test_make_small_dataset(self):
-        filename = '/path/to/dataset.tsv'
-        dest_path = '/path/to/dataset_size_1.tsv'
-        read_data = 'Rock n Roll is a risk. You rick being ridiculed.\tDo you like rock music?\n' \
-            'Rock n Roll is a risk.\tDo you like rock?'
-        open_ = patch('utils.open', mock_open(read_data=read_data)).start()
-        open_.return_value.__iter__.return_value = read_data.split('\n')
-        writer = patch('csv.writer').start()
-        make_small_dataset(filename, 1)
-        open_.assert_has_calls([call(filename), call(dest_path, 'w')], any_order=True)
-        writer.assert_called_once_with(open_.return_value, delimiter='\t')
-        writer.return_value.writerow.assert_called_once()
-        patch.stopall()
+        with tempfile.TemporaryDirectory() as dirname:
+            filename, rows = self.write_dataset(dirname)
+            dest_path = make_small_dataset(filename, 3, seed=0)
+            self.assertEqual(dest_path, os.path.join(dirname, 'dataset_size_3.tsv'))
+            sample = self.read_dataset(dest_path)
+            self.assertEqual(len(sample), 3)
+            # sampled rows keep the file order
+            indices = [rows.index(row) for row in sample]
+            self.assertEqual(indices, sorted(indices))
+            np.testing.assert_array_equal(
+                np.load(f'{dest_path}.lengths.npy')[:, 0], [i * 2 for i in indices])
+
+            make_small_dataset(filename, 3, overwrite=True, seed=0)
+            self.assertEqual(self.read_dataset(dest_path), sample)
+            with self.assertRaises(FileExistsError):
+                make_small_dataset(filename, 3)
+
+    def test_stale_lengths(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename, rows = self.write_dataset(dirname)
+            np.save(f'{filename}.lengths.npy', np.zeros((20, 2), dtype=np.int32))
+            with self.assertRaisesRegex(ValueError, 'lengths.npy has 20 rows'):
+                split_dataset(filename, seed=0)
 
     def test_split_dataset(self):
-        filename = '/path/to/dataset.tsv'
-        train_filename = '/path/to/dataset_train.tsv'
-        dev_filename = '/path/to/dataset_dev.tsv'
-        read_data = 'Rock n Roll is a risk. You rick being ridiculed.\tDo you like rock music?\n' \
-            'Rock n Roll is a risk.\tDo you like rock?'
-        open_ = patch('utils.open', mock_open(read_data=read_data)).start()
-        open_.return_value.__iter__.return_value = read_data.split('\n')
-        writer = patch('csv.writer').start()
-        split_dataset(filename)
-        open_.assert_has_calls(
-            [call(filename), call(train_filename, 'w'), call(dev_filename, 'w')],
-            any_order=True)
-        writer.assert_called_with(open_.return_value, delimiter='\t')
-        writer.return_value.writerow.assert_called()
-        patch.stopall()
+        with tempfile.TemporaryDirectory() as dirname:
+            filename, rows = self.write_dataset(dirname)
+            train_path, dev_path = split_dataset(filename, seed=0)
+            self.assertEqual(train_path, os.path.join(dirname, 'dataset_train.tsv'))
+            self.assertEqual(dev_path, os.path.join(dirname, 'dataset_dev.tsv'))
+            train, dev = self.read_dataset(train_path), self.read_dataset(dev_path)
+            self.assertEqual(len(train), 8)
+            self.assertEqual(len(dev), 2)
+            self.assertCountEqual(train + dev, rows)
+            self.assertEqual(np.load(f'{dev_path}.lengths.npy').shape, (2, 2))
+            with self.assertRaises(FileExistsError):
+                split_dataset(filename)
+
+            paths = split_dataset(filename, [.5, .3, .2], overwrite=True, seed=1)
+            splits = [self.read_dataset(path) for path in paths]
+            self.assertEqual([len(split) for split in splits], [5, 3, 2])
+            self.assertCountEqual(sum(splits, []), rows)
+            self.assertEqual(paths[2], os.path.join(dirname, 'dataset_test.tsv'))
+            again = split_dataset(filename, [.5, .3, .2], overwrite=True, seed=1)
+            self.assertEqual([self.read_dataset(path) for path in again], splits)
+
+    def test_convert_squad_json(self):
+        data = {'data': [{'paragraphs': [{
+            'context': 'Rock n Roll is a risk.\nYou risk being ridiculed.',
+            'qas': [
+                {'question': 'What is your risk?',
+                 'answers': [{'text': 'ridiculed', 'answer_start': 38},
+                             {'text': 'being ridiculed', 'answer_start': 32},
+                             {'text': 'ridiculed', 'answer_start': 38}]},
+                {'question': 'Is it a risk?', 'answers': []}]}]}]}
+        with tempfile.TemporaryDirectory() as dirname:
+            json_path = os.path.join(dirname, 'squad.json')
+            tsv_path = os.path.join(dirname, 'squad.tsv')
+            with open(json_path, 'w') as f:
+                json.dump(data, f)
+            convert_squad_json(json_path, tsv_path)
+            with open(tsv_path) as f:
+                rows = list(csv.reader(f, delimiter='\t'))
+        context = 'Rock n Roll is a risk. You risk being ridiculed.'
+        self.assertEqual(rows, [
+            [context, 'What is your risk?', '38', '47', 'ridiculed', 'being ridiculed'],
+            [context, 'Is it a risk?', '-1', '-1', '']])
+
+    def test_save_word_embedding_as_npy(self):
+        lines = '3 2\nrock 0.1 0.2\nn 1 -1\nroll 2.5 3\n'
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, 'wiki.vec')
+            with open(filename, 'w') as f:
+                f.write(lines)
+            token_to_index, embeddings = save_word_embedding_as_npy(filename, 2)
+            expected = np.array([[.1, .2], [1, -1], [2.5, 3]], dtype=np.float32)
+            self.assertEqual(token_to_index, {'rock': 0, 'n': 1, 'roll': 2})
+            np.testing.assert_array_equal(embeddings, expected)
+
+            loaded_token_to_index, loaded_embeddings = load_word_embedding(filename)
+            self.assertEqual(loaded_token_to_index, token_to_index)
+            self.assertIsInstance(loaded_embeddings, np.memmap)
+            np.testing.assert_array_equal(loaded_embeddings, expected)
+
+    def test_load_word_index_dict(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, 'wiki.vec.dict')
+            with open(filename, 'wb') as f:
+                pickle.dump({'rock': 0}, f)
+            self.assertEqual(load_word_index(filename), {'rock': 0})
+            self.assertEqual(load_word_index(filename, vocab=['roll']), {})
+
+    def test_load_word_index_vocab(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, 'wiki.vec.words')
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write('rock\nn\nroll\n')
+            self.assertEqual(load_word_index(filename), {'rock': 0, 'n': 1, 'roll': 2})
+            self.assertEqual(load_word_index(filename, vocab={'<pad>': 0, 'roll': 1, 'rock': 2}),
+                             {'rock': 0, 'roll': 2})
+
+    def test_extract_embeddings(self):
+        vocab = {'<pad>': 0, '<unk>': 1, 'rock': 2, 'roll': 3}
+        big_vocab = {'roll': 0, 'n': 1, 'rock': 2}
+        big_embeddings = np.arange(12, dtype=np.float32).reshape(3, 4)
+        embeddings, oov_rate = extract_embeddings(vocab, big_vocab, big_embeddings, return_oov=True)
+        expected = np.array([[0] * 4, [0] * 4, [8, 9, 10, 11], [0, 1, 2, 3]], dtype=np.float32)
+        np.testing.assert_array_equal(embeddings, expected)
+        self.assertEqual(oov_rate, .5)
+        _, oov_rate = extract_embeddings(
+            vocab, big_vocab, big_embeddings, return_oov=True, special_indices=[0, 1])
+        self.assertEqual(oov_rate, 0.)
+        _, oov_rate = extract_embeddings(
+            dict(vocab, ridiculed=4), big_vocab, big_embeddings, return_oov=True, special_indices=[0, 1])
+        self.assertAlmostEqual(oov_rate, 1 / 3)
+
+        embeddings = extract_embeddings(vocab, big_vocab, big_embeddings, oov_init='mean', pad_index=0)
+        np.testing.assert_array_equal(embeddings[0], np.zeros(4))
+        np.testing.assert_array_equal(embeddings[1], [4, 5, 6, 7])
+
+        first = extract_embeddings(vocab, big_vocab, big_embeddings, oov_init='normal', seed=1, pad_index=0)
+        second = extract_embeddings(vocab, big_vocab, big_embeddings, oov_init='normal', seed=1, pad_index=0)
+        np.testing.assert_array_equal(first, second)
+        np.testing.assert_array_equal(first[2:], expected[2:])
+        self.assertTrue(np.all(first[1] != 0))
+
+        with self.assertRaises(ValueError):
+            extract_embeddings(vocab, big_vocab, big_embeddings, dim=300)
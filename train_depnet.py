@@ -43,7 +43,8 @@ def main(args):
     trainer = SquadTrainer(model, train_generator, epochs, dev_generator,
                            './model/dep.{epoch:02d}-{val_loss:.2f}.h5')
     trainer.add_callback(BatchLearningRateScheduler())
-    trainer.add_callback(ExponentialMovingAverage(0.999))
+    # ahead of ModelCheckpoint, so that the saved weights are the averages
+    trainer.callbacks.insert(0, ExponentialMovingAverage(0.999).attach(model))
     if args.use_tensorboard:
         trainer.add_callback(TensorBoard(log_dir='./graph', batch_size=batch_size))
     history = trainer.run()
@@ -2,12 +2,14 @@ import os
 from argparse import ArgumentParser
 
 import numpy as np
-from keras.optimizers import Adam
 from keras.callbacks import TensorBoard
+from keras.optimizers import Adam
 
 from models import QANet
-from data import SquadReader, Iterator, SquadConverter, Vocabulary
-from trainer import SquadTrainer, BatchLearningRateScheduler  # , ExponentialMovingAverage
+from data import SquadReader, Iterator, SquadConverter, Vocabulary, \
+    SquadCache, SquadCacheConverter, PrefetchIterator, BucketIterator
+from trainer import SquadTrainer, BatchLearningRateScheduler, AccumulatingAdam, \
+    ExponentialMovingAverage, TrainingCheckpoint, MisalignedSpanLogger
 from utils import dump_graph
 
 from prepare_vocab import PAD_TOKEN, UNK_TOKEN
@@ -24,26 +26,84 @@ def main(args):
     batch_size = args.batch  # Batch size for training.
     epochs = args.epoch  # Number of epochs to train for.
 
+    boundaries = args.bucket_boundaries if args.bucket else None
+    if args.use_cache:
+        train_dataset = SquadCache(SquadCache.path(args.train_path))
+        dev_dataset = SquadCache(SquadCache.path(args.dev_path))
+        for dataset in (train_dataset, dev_dataset):
+            # the lengths SquadConverter pads to below
+            dataset.check(len(token_to_index), context_max_len=400, question_max_len=50)
+        converter = dev_converter = SquadCacheConverter(bucket_boundaries=boundaries)
+    else:
+        train_dataset = SquadReader(args.train_path)
+        dev_dataset = SquadReader(args.dev_path)
+        # dev batches get a converter of their own, so that MisalignedSpanLogger
+        # counts the training spans only
+        converter, dev_converter = (
+            SquadConverter(token_to_index, PAD_TOKEN, UNK_TOKEN, lower=args.lower,
+                           bucket_boundaries=boundaries) for _ in range(2))
+    if args.bucket:
+        if args.use_cache:
+            train_lengths = train_dataset.context_lengths
+            dev_lengths = dev_dataset.context_lengths
+        else:
+            # [context, question] token lengths written next to the TSV by utils.filter_dataset
+            lengths_paths = [f'{path}.lengths.npy' for path in (args.train_path, args.dev_path)]
+            if not all(os.path.exists(path) for path in lengths_paths):
+                raise ValueError('--bucket needs the context lengths stored by --use-cache '
+                                 'or the .lengths.npy files written by filter_dataset')
+            train_lengths, dev_lengths = (np.load(path, mmap_mode='r')[:, 0] for path in lengths_paths)
+        train_generator = BucketIterator(train_dataset, batch_size, converter, train_lengths, boundaries)
+        dev_generator = BucketIterator(dev_dataset, batch_size, dev_converter, dev_lengths, boundaries)
+    else:
+        train_generator = Iterator(train_dataset, batch_size, converter)
+        dev_generator = Iterator(dev_dataset, batch_size, dev_converter)
+    if args.num_workers > 0:
+        # fork the workers before TensorFlow starts its own threads
+        train_generator = PrefetchIterator(train_generator, args.num_workers, args.prefetch)
+        dev_generator = PrefetchIterator(dev_generator, args.num_workers, args.prefetch)
+
     model = QANet(len(token_to_index), args.embed, args.hidden, args.num_heads,
                   encoder_num_blocks=args.encoder_layer, encoder_num_convs=args.encoder_conv,
                   output_num_blocks=args.output_layer, output_num_convs=args.output_conv,
-                  dropout=args.dropout, embeddings=embeddings).build()
-    opt = Adam(lr=0.001, beta_1=0.8, beta_2=0.999, epsilon=1e-7, clipnorm=5.)
+                  dropout=args.dropout, embeddings=embeddings,
+                  cont_limit=None if args.bucket else 400,
+                  ques_limit=None if args.bucket else 50,
+                  compute_dtype=args.compute_dtype).build()
+    adam_args = dict(lr=0.001, beta_1=0.8, beta_2=0.999, epsilon=1e-7, clipnorm=5.)
+    if args.accumulation_steps > 1:
+        # one optimizer step per accumulation_steps batches: an effective batch of batch * accumulation_steps
+        opt = AccumulatingAdam(accumulation_steps=args.accumulation_steps, **adam_args)
+    else:
+        opt = Adam(**adam_args)
     model.compile(optimizer=opt,
                   loss=['sparse_categorical_crossentropy',
                         'sparse_categorical_crossentropy', None, None], loss_weights=[1, 1, 0, 0])
-    train_dataset = SquadReader(args.train_path)
-    dev_dataset = SquadReader(args.dev_path)
-    converter = SquadConverter(token_to_index, PAD_TOKEN, UNK_TOKEN, lower=args.lower)
-    train_generator = Iterator(train_dataset, batch_size, converter)
-    dev_generator = Iterator(dev_dataset, batch_size, converter)
     trainer = SquadTrainer(model, train_generator, epochs, dev_generator,
                            './model/qanet.{epoch:02d}-{val_loss:.2f}.h5')
     trainer.add_callback(BatchLearningRateScheduler())
-    # trainer.add_callback(ExponentialMovingAverage(0.999))
+    if args.use_cache:
+        # counted once when the caches were built
+        print(f'misaligned answer spans: {train_dataset.misaligned} in the training cache, '
+              f'{dev_dataset.misaligned} in the dev cache')
+    else:
+        trainer.add_callback(MisalignedSpanLogger(converter))
+    ema = None
+    if args.ema_decay > 0:
+        ema = ExponentialMovingAverage(args.ema_decay).attach(model)
+        # ahead of ModelCheckpoint, so that the saved weights are the averages
+        trainer.callbacks.insert(0, ema)
+    checkpoint = TrainingCheckpoint(args.checkpoint_path, train_generator, ema, args.checkpoint_period)
+    trainer.add_callback(checkpoint)
     if args.use_tensorboard:
         trainer.add_callback(TensorBoard(log_dir='./graph', batch_size=batch_size))
-    history = trainer.run()
+    try:
+        initial_epoch, initial_batch = checkpoint.restore(model) if args.resume else (0, 0)
+        history = trainer.run(initial_epoch, initial_batch)
+    finally:
+        if args.num_workers > 0:
+            train_generator.close()
+            dev_generator.close()
     dump_graph(history, 'loss_graph.png')
 
 
@@ -51,6 +111,7 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--epoch', default=100, type=int)
     parser.add_argument('--batch', default=32, type=int)
+    parser.add_argument('--accumulation-steps', default=1, type=int)
     parser.add_argument('--embed', default=300, type=int)
     parser.add_argument('--hidden', default=96, type=int)
     parser.add_argument('--num-heads', default=1, type=int)
@@ -59,11 +120,22 @@ if __name__ == '__main__':
     parser.add_argument('--output-layer', default=7, type=int)
     parser.add_argument('--output-conv', default=2, type=int)
     parser.add_argument('--dropout', default=.1, type=float)
+    parser.add_argument('--ema-decay', default=0.999, type=float)
+    parser.add_argument('--compute-dtype', default='float32', choices=['float32', 'float16'])
     parser.add_argument('--train-path', default='./data/train-v1.1_filtered_train.txt', type=str)
     parser.add_argument('--dev-path', default='./data/train-v1.1_filtered_dev.txt', type=str)
     parser.add_argument('--test-path', default='./data/dev-v1.1_filtered.txt', type=str)
     parser.add_argument('--vocab-file', default='./data/vocab_question_context_min-freq10_max_size.pkl', type=str)
     parser.add_argument('--lower', default=False, action='store_true')
     parser.add_argument('--use-tensorboard', default=False, action='store_true')
+    parser.add_argument('--checkpoint-path', default='./model/checkpoint.pkl', type=str)
+    parser.add_argument('--checkpoint-period', default=1000, type=int)
+    parser.add_argument('--resume', default=False, action='store_true')
+    parser.add_argument('--use-cache', default=False, action='store_true')
+    parser.add_argument('--num-workers', default=0, type=int)
+    parser.add_argument('--prefetch', default=4, type=int)
+    parser.add_argument('--bucket', default=False, action='store_true')
+    parser.add_argument('--bucket-boundaries', nargs='+', type=int,
+                        default=[50, 100, 150, 200, 250, 300, 350, 400])
     args = parser.parse_args()
     main(args)
@@ -1,7 +1,11 @@
+import os
 import math
+import pickle
 
+import tensorflow as tf
 from keras import backend as K
 from keras.callbacks import ModelCheckpoint, Callback
+from keras.optimizers import Adam, clip_norm
 
 
 class SquadTrainer:
@@ -12,45 +16,258 @@ class SquadTrainer:
         self.epoch = epoch
         self.callbacks = [ModelCheckpoint(save_path)]
 
-    def run(self):
+    def run(self, initial_epoch=0, initial_batch=0):
+        partial = None
+        if initial_batch:
+            # a run resumed mid-epoch first trains on the rest of that epoch, so that epochs
+            # keep ending where the data do; workers=0 keeps Keras from reading batches
+            # ahead that the next call would never train on
+            partial = self._fit(initial_epoch, initial_epoch + 1,
+                                len(self.train_generator) - initial_batch, workers=0)
+            initial_epoch += 1
+        history = self._fit(initial_epoch, self.epoch, len(self.train_generator))
+        if partial is not None:
+            for key, values in partial.history.items():
+                history.history[key] = values + history.history.get(key, [])
+            history.epoch = partial.epoch + history.epoch
+        return history
+
+    def _fit(self, initial_epoch, epochs, steps_per_epoch, **kwargs):
         return self.model.fit_generator(
-            generator=self.train_generator, epochs=self.epoch, validation_data=self.dev_generator or None,
-            steps_per_epoch=len(self.train_generator), validation_steps=len(self.dev_generator),
-            callbacks=self.callbacks)
+            generator=self.train_generator, epochs=epochs, validation_data=self.dev_generator or None,
+            steps_per_epoch=steps_per_epoch, validation_steps=len(self.dev_generator),
+            callbacks=self.callbacks, initial_epoch=initial_epoch, **kwargs)
 
     def add_callback(self, callback):
         self.callbacks.append(callback)
 
 
+class AccumulatingAdam(Adam):
+    # Adam that sums the gradients of accumulation_steps micro-batches and takes one
+    # step with their mean, clipped as a whole; iterations counts optimizer steps
+    def __init__(self, accumulation_steps=1, **kwargs):
+        super().__init__(**kwargs)
+        self.accumulation_steps = accumulation_steps
+        with K.name_scope(self.__class__.__name__):
+            self.micro_iterations = K.variable(0, dtype='int64', name='micro_iterations')
+
+    def get_updates(self, loss, params):
+        grads = K.gradients(loss, params)
+        if None in grads:
+            raise ValueError('An operation has `None` for gradient. '
+                             'Please make sure that all of your ops have a gradient defined.')
+        micro_iterations = K.update_add(self.micro_iterations, 1)
+        # True on the micro-batch that completes an accumulation
+        self.apply_step = K.equal(micro_iterations % self.accumulation_steps, 0)
+        iterations = K.update_add(self.iterations, K.cast(self.apply_step, 'int64'))
+        self.updates = [micro_iterations, iterations]
+
+        accumulators = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        sums = [a + g for a, g in zip(accumulators, grads)]
+        grads = [g / self.accumulation_steps for g in sums]
+        if getattr(self, 'clipnorm', 0) > 0:
+            norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+            grads = [clip_norm(g, self.clipnorm, norm) for g in grads]
+        if getattr(self, 'clipvalue', 0) > 0:
+            grads = [K.clip(g, -self.clipvalue, self.clipvalue) for g in grads]
+
+        lr = self.lr
+        if self.initial_decay > 0:
+            lr = lr * (1. / (1. + self.decay * K.cast(iterations - 1, K.dtype(self.decay))))
+        t = K.cast(iterations, K.floatx())
+        lr_t = lr * (K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t)))
+
+        ms = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        vs = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        if self.amsgrad:
+            vhats = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        else:
+            vhats = [K.zeros(1) for _ in params]
+        self.weights = [self.iterations] + ms + vs + vhats + [self.micro_iterations] + accumulators
+
+        def update(x, new_x):
+            # x only changes on the micro-batch that completes an accumulation
+            return K.update(x, K.switch(self.apply_step, new_x, x))
+
+        for p, g, s, a, m, v, vhat in zip(params, grads, sums, accumulators, ms, vs, vhats):
+            m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
+            v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g)
+            if self.amsgrad:
+                vhat_t = K.maximum(vhat, v_t)
+                p_t = p - lr_t * m_t / (K.sqrt(vhat_t) + self.epsilon)
+                self.updates.append(update(vhat, vhat_t))
+            else:
+                p_t = p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
+            if getattr(p, 'constraint', None) is not None:
+                p_t = p.constraint(p_t)
+            self.updates.append(update(m, m_t))
+            self.updates.append(update(v, v_t))
+            self.updates.append(update(p, p_t))
+            self.updates.append(K.update(a, K.switch(self.apply_step, K.zeros_like(s), s)))
+        return self.updates
+
+    def get_config(self):
+        config = super().get_config()
+        config['accumulation_steps'] = self.accumulation_steps
+        return config
+
+
 class BatchLearningRateScheduler(Callback):
+    # the warmup follows optimizer steps, which are fewer than batches
+    # when the optimizer accumulates gradients
     def on_train_begin(self, logs={}):
-        self.global_step = 1
+        self.global_step = K.get_value(self.model.optimizer.iterations) + 1
         lr = min(0.001, 0.001 / math.log(1000) * math.log(self.global_step))
         K.set_value(self.model.optimizer.lr, lr)
 
     def on_batch_end(self, batch, logs={}):
-        self.global_step += 1
+        global_step = K.get_value(self.model.optimizer.iterations) + 1
+        if global_step == self.global_step:
+            return  # the gradients are still being accumulated
+        self.global_step = global_step
         if self.global_step <= 1000:
             lr = min(0.001, 0.001 / math.log(1000) * math.log(self.global_step))
             K.set_value(self.model.optimizer.lr, lr)
 
 
 class ExponentialMovingAverage(Callback):
+    # the averages are shadow variables updated by the train function itself,
+    # so no weight leaves the graph until they are assigned at the end of an epoch;
+    # attach(model) must be called after compile and before fit/fit_generator
     def __init__(self, decay=0.999):
         super().__init__()
         self.decay = decay
+        self.train_function = None
+        # averages restored by TrainingCheckpoint, used instead of the current weights
+        self.initial_averages = None
+
+    def attach(self, model):
+        # fit keeps the train function it finds before any callback runs, so the
+        # shadow updates are added to it here rather than in on_train_begin
+        self.set_model(model)
+        model._make_train_function()
+        weights = model.trainable_weights
+        self.shadows = [K.zeros(K.int_shape(w), dtype=K.dtype(w)) for w in weights]
+        self.reset_op = tf.group(*[tf.assign(s, w) for s, w in zip(self.shadows, weights)])
+        self.assign_op = tf.group(*[tf.assign(w, s) for s, w in zip(self.shadows, weights)])
+
+        decay = K.constant(self.decay)
+        apply_step = getattr(model.optimizer, 'apply_step', None)
+        if apply_step is not None:
+            # averages once per optimizer step, not per accumulated micro-batch
+            decay = tf.where(apply_step, decay, K.constant(1.))
+        train_function = model.train_function
+        with tf.control_dependencies([train_function.updates_op]):
+            # the weights are read after the optimizer has updated them
+            updates = [tf.assign_sub(s, (1. - decay) * (s - w.read_value()))
+                       for s, w in zip(self.shadows, weights)]
+        session_kwargs = dict(train_function.session_kwargs)
+        if getattr(train_function, 'fetches', None):
+            session_kwargs['fetches'] = train_function.fetches
+        if getattr(train_function, 'feed_dict', None):
+            session_kwargs['feed_dict'] = train_function.feed_dict
+        self.train_function = K.function(
+            train_function.inputs, train_function.outputs, updates=updates,
+            name='train_function', **session_kwargs)
+        model.train_function = self.train_function
+        return self
 
     def on_train_begin(self, logs={}):
-        weights = {}
-        for weight in self.model.trainable_weights:
-            weights[weight.name] = K.get_value(weight)
-        self.weights = weights
+        if self.train_function is None or self.model.train_function is not self.train_function:
+            raise RuntimeError('ExponentialMovingAverage.attach(model) must be called '
+                               'after compile and before training')
+        if self.initial_averages is not None:
+            K.batch_set_value(list(zip(self.shadows, self.initial_averages)))
+            self.initial_averages = None
+        else:
+            # the averages start from the current weights
+            K.get_session().run(self.reset_op)
+
+    def on_epoch_end(self, epoch, logs={}):
+        K.get_session().run(self.assign_op)
+
+
+class MisalignedSpanLogger(Callback):
+    # reports the answer spans a SquadConverter could not align to tokens, counted over
+    # the batches it converted during each epoch; give it the training converter only, as
+    # the dev iterator's conversions would land in the same counts. The generator queue
+    # of fit_generator reads a few batches ahead, which may be counted an epoch early
+    def __init__(self, converter):
+        super().__init__()
+        self.converter = converter
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.total = self.converter.total_spans
+        self.misaligned = self.converter.misaligned_spans
+
+    def on_epoch_end(self, epoch, logs={}):
+        total = self.converter.total_spans - self.total
+        misaligned = self.converter.misaligned_spans - self.misaligned
+        logs['misaligned_spans'] = misaligned
+        print(f'misaligned answer spans: {misaligned}/{total}')
+
+
+class TrainingCheckpoint(Callback):
+    # everything a preempted run needs to go on where it stopped: the weights, the
+    # optimizer slots and step (which BatchLearningRateScheduler follows), the EMA
+    # averages and the position of the training iterator, in one file replaced atomically
+    def __init__(self, filepath, iterator, ema=None, period=1000):
+        super().__init__()
+        self.filepath = filepath
+        self.iterator = iterator
+        self.ema = ema
+        self.period = period
+        self.epoch = 0
+        # batches already trained on in the epoch a restored run resumes
+        self.initial_batch = 0
+
+    def on_train_begin(self, logs={}):
+        # Keras reads batches ahead of training, so the iterator is saved as it is
+        # now together with the number of batches trained on since
+        self.iterator_state = self.iterator.get_state()
+        self.batches = 0
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.epoch = epoch
+        self.epoch_batches = self.initial_batch
+        self.initial_batch = 0
 
     def on_batch_end(self, batch, logs={}):
-        for weight in self.model.trainable_weights:
-            old_weight = self.weights[weight.name]
-            self.weights[weight.name] = self.decay * old_weight + (1 - self.decay) * K.get_value(weight)
+        self.batches += 1
+        self.epoch_batches += 1
+        # the last batch of an epoch is saved by on_epoch_end
+        if self.period and self.batches % self.period == 0 and \
+           self.epoch_batches < (self.params.get('steps') or math.inf):
+            self.save(self.epoch, self.epoch_batches)
 
     def on_epoch_end(self, epoch, logs={}):
-        for weight in self.model.trainable_weights:
-            K.set_value(weight, self.weights[weight.name])
+        self.save(epoch + 1, 0)
+
+    def save(self, epoch, epoch_batches):
+        state = {
+            'epoch': epoch,
+            'epoch_batches': epoch_batches,
+            'weights': self.model.get_weights(),
+            'optimizer': self.model.optimizer.get_weights(),
+            'ema': K.batch_get_value(self.ema.shadows) if self.ema is not None else None,
+            'iterator': self.iterator_state,
+            'batches': self.batches}
+        tmp_path = f'{self.filepath}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.filepath)
+
+    def restore(self, model):
+        # loads a checkpoint into a compiled model and the iterator, returns the epoch to
+        # resume from and the number of its batches already trained on, for SquadTrainer.run
+        with open(self.filepath, 'rb') as f:
+            state = pickle.load(f)
+        model.set_weights(state['weights'])
+        # the optimizer slots only exist once the train function is built
+        model._make_train_function()
+        model.optimizer.set_weights(state['optimizer'])
+        if self.ema is not None:
+            self.ema.initial_averages = state['ema']
+        self.iterator.set_state(state['iterator'], skip=state['batches'])
+        self.initial_batch = state['epoch_batches']
+        return state['epoch'], state['epoch_batches']
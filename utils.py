@@ -1,50 +1,134 @@
 import os
 import csv
-import random
+import json
 import pickle
-import linecache
+import mmap
+import multiprocessing
+from collections import deque
+from functools import lru_cache
 
 from tqdm import tqdm
-import tensorflow as tf
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt  # noqa
 
 
+def _bisect_offsets(token_offsets, column, value, lo=0):
+    # bisect_left over one column of the sorted (start, end) pairs
+    hi = len(token_offsets)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if token_offsets[mid][column] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
 def char_span_to_token_span(token_offsets, char_start, char_end):
     if char_start < 0:
         return (-1, -1), False
+    if not len(token_offsets):
+        return (-1, -1), True
 
-    error = False
+    last = len(token_offsets) - 1
+    start_index = _bisect_offsets(token_offsets, 0, char_start)
+    # step back to the token containing char_start
+    if start_index > last or token_offsets[start_index][0] > char_start:
+        start_index = max(start_index - 1, 0)
+    error = token_offsets[start_index][0] != char_start
 
-    start_index = 0
-    while start_index < len(token_offsets) and token_offsets[start_index][0] < char_start:
-        start_index += 1
-    if token_offsets[start_index][0] > char_start:
-        start_index -= 1
-    if token_offsets[start_index][0] != char_start:
-        error = True
-
-    end_index = start_index
-    while end_index < len(token_offsets) and token_offsets[end_index][1] < char_end:
-        end_index += 1
+    end_index = min(_bisect_offsets(token_offsets, 1, char_end, start_index), last)
     if token_offsets[end_index][1] != char_end:
         error = True
     return (start_index, end_index), error
 
 
-def get_spans(contexts, starts, ends):
-    spans = []
-    for context, start, end in zip(contexts, starts, ends):
-        context_offsets = [(token.idx, token.idx + len(token.text)) for token in context]
-        span, error = char_span_to_token_span(context_offsets, start, end)
-        if error:
-            ...
+def align_spans(token_offsets, lengths, char_starts, char_ends):
+    # batched char_span_to_token_span over padded [batch, max_len, 2] token offsets,
+    # returns [batch, 2] token spans and a [batch] bool array of misalignments
+    token_offsets = np.asarray(token_offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    char_starts = np.asarray(char_starts, dtype=np.int64)
+    char_ends = np.asarray(char_ends, dtype=np.int64)
+    batch_size, max_len, _ = token_offsets.shape
+    if max_len == 0:
+        token_offsets = np.zeros((batch_size, 1, 2), dtype=np.int64)
+        max_len = 1
+
+    # rows are laid end to end on one sorted axis so a single searchsorted serves
+    # the whole batch, padding sorts after every real offset of its row
+    stride = max(token_offsets.max(initial=0), char_starts.max(initial=0),
+                 char_ends.max(initial=0)) + 2
+    rows = np.arange(batch_size)
+    row_base = rows * stride
+    valid = np.arange(max_len) < lengths[:, None]
+    token_starts = np.where(valid, token_offsets[..., 0], stride - 1) + row_base[:, None]
+    token_ends = np.where(valid, token_offsets[..., 1], stride - 1) + row_base[:, None]
+    last = np.maximum(lengths - 1, 0)
+
+    start_index = np.searchsorted(token_starts.ravel(), row_base + char_starts) - rows * max_len
+    clipped = np.clip(start_index, 0, last)
+    step_back = (start_index > last) | (token_offsets[rows, clipped, 0] > char_starts)
+    start_index = np.clip(np.where(step_back, start_index - 1, start_index), 0, last)
+
+    end_index = np.searchsorted(token_ends.ravel(), row_base + char_ends) - rows * max_len
+    end_index = np.clip(np.maximum(end_index, start_index), 0, last)
+
+    errors = (token_offsets[rows, start_index, 0] != char_starts) | \
+        (token_offsets[rows, end_index, 1] != char_ends) | (lengths == 0)
+    spans = np.stack([start_index, end_index], axis=1)
+    unanswerable = char_starts < 0
+    spans[unanswerable | (lengths == 0)] = -1
+    errors &= ~unanswerable
+    return spans, errors
+
+
+def get_spans(contexts, starts, ends, return_errors=False):
+    lengths = [len(context) for context in contexts]
+    offsets = np.zeros((len(contexts), max(lengths, default=0), 2), dtype=np.int64)
+    for i, context in enumerate(contexts):
+        if context:
+            offsets[i, :len(context)] = [(token.idx, token.idx + len(token.text)) for token in context]
+    spans, errors = align_spans(offsets, lengths, starts, ends)
+    spans = [tuple(span) for span in spans.tolist()]
+    if return_errors:
+        return spans, errors
+    return spans
 
-        spans.append(span)
 
-    return spans
+def line_offsets(filename, chunk_size=1 << 24):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            offsets.append(newlines.astype(np.int64) + position + 1)
+            position += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:
+        offsets = np.append(offsets, position)
+    return offsets
+
+
+def load_line_offsets(filename):
+    # offsets are cached next to the file and rebuilt when the file changes
+    index_file = f'{filename}.offsets.npy'
+    if os.path.exists(index_file) and \
+       os.path.getmtime(index_file) >= os.path.getmtime(filename):
+        offsets = np.load(index_file, mmap_mode='r')
+        if len(offsets) and offsets[-1] == os.path.getsize(filename):
+            return offsets
+    offsets = line_offsets(filename)
+    try:
+        np.save(index_file, offsets)
+    except OSError:
+        pass
+    return offsets
 
 
 def dump_graph(history, filename):
@@ -57,33 +141,47 @@ def dump_graph(history, filename):
     plt.savefig(filename)
 
 
+@lru_cache(maxsize=32)
+def span_band(length, answer_limit):
+    # (length, length) mask of spans with start <= end <= start + answer_limit;
+    # bounded, as variable-length batches each have a length of their own
+    band = np.triu(np.ones((length, length), dtype=np.float32))
+    return band - np.triu(band, answer_limit + 1)
+
+
+def decode_spans(start_scores, end_scores, answer_limit=30):
+    batch_size, length = start_scores.shape
+    scores = start_scores[:, :, None] * end_scores[:, None, :]
+    scores *= span_band(length, answer_limit)
+    best = scores.reshape(batch_size, -1).argmax(axis=1)
+    return best // length, best % length
+
+
 def evaluate(model, test_generator, metric, index_to_token, answer_limit=30):
-    count = 0
+    # only the start/end probabilities are used, so `model` may be the span_model
     for inputs, answer in test_generator:
-        start_scores, end_scores, S_q, S_c = model.predict_on_batch(inputs)
-        scores = tf.matmul(tf.expand_dims(start_scores, axis=2),
-                           tf.expand_dims(end_scores, axis=1))
-        scores = tf.matrix_band_part(scores, 0, answer_limit)
-        start_indices = tf.argmax(tf.reduce_max(scores, axis=2, keepdims=True), axis=1)
-        end_indices = tf.argmax(tf.reduce_max(scores, axis=1, keepdims=True), axis=2)
-
-        with tf.Session() as sess:
-            start_indices = sess.run(start_indices).reshape(-1)
-            end_indices = sess.run(end_indices).reshape(-1)
-
-        questions, contexts = inputs
-        for i, (start, end) in enumerate(zip(start_indices, end_indices)):
-            context = [index_to_token[x] for x in contexts[i] if x]
-            question = [index_to_token[x] for x in questions[i] if x]
-            if random.random() > .5 and count < 20:
-                visualize(question, context, answer[i], [S_c[i], S_q[i]], f'attention_{count}.png')
-                count += 1
-            prediction = ' '.join(context[j] for j in range(start, end + 1))
-
-            metric(prediction, answer[i])
+        start_scores, end_scores = model.predict_on_batch(inputs)[:2]
+        start_indices, end_indices = decode_spans(start_scores, end_scores, answer_limit)
+
+        _, contexts = inputs
+        predictions = [
+            ' '.join(index_to_token[x] for x in contexts[i, start:end + 1])
+            for i, (start, end) in enumerate(zip(start_indices, end_indices))]
+        metric.update(predictions, answer)
     return metric.get_metric()
 
 
+def visualize_attention(model, dataset, converter, example_ids, index_to_token):
+    batch = [dataset[i] for i in example_ids]
+    inputs, answers = converter(batch)
+    _, _, S_q, S_c = model.predict_on_batch(inputs)
+    questions, contexts = inputs
+    for i, example_id in enumerate(example_ids):
+        context = [index_to_token[x] for x in contexts[i] if x]
+        question = [index_to_token[x] for x in questions[i] if x]
+        visualize(question, context, answers[i], [S_c[i], S_q[i]], f'attention_{example_id}.png')
+
+
 def visualize(question, context, answer, scores, filename):
     names = ['q2c', 'c2q']
     for j, score in enumerate(scores):
@@ -108,6 +206,7 @@ def visualize(question, context, answer, scores, filename):
 
         f.set_size_inches(40, 12)
         f.savefig(f'{names[j]}_{filename}', dpi=100)
+        plt.close(f)
 
     # grid_kws = {'height_ratios': (.95, .05), 'hspace': 0}
     # f, (ax, cbar_ax) = plt.subplots(2, gridspec_kw=grid_kws, figsize=(40, 12))
@@ -120,111 +219,264 @@ def visualize(question, context, answer, scores, filename):
     # f.savefig(filename, dpi=100)
 
 
-def filter_dataset(filename, question_max_length=50, context_max_length=400):
+def convert_squad_json(json_path, tsv_path):
+    # one row per question: context, question, start, end, answer_1, answer_2, ...
+    # newlines and tabs are replaced by spaces so character offsets stay valid
+    table = str.maketrans('\t\n\r', '   ')
+    with open(json_path) as f:
+        articles = json.load(f)['data']
+    with open(tsv_path, 'w') as f:
+        writer = csv.writer(f, delimiter='\t')
+        for article in articles:
+            for paragraph in article['paragraphs']:
+                context = paragraph['context'].translate(table)
+                for qa in paragraph['qas']:
+                    answers = qa['answers']
+                    if not answers:
+                        writer.writerow([context, qa['question'].translate(table), -1, -1, ''])
+                        continue
+                    start = answers[0]['answer_start']
+                    end = start + len(answers[0]['text'])
+                    texts = list(dict.fromkeys(answer['text'].translate(table) for answer in answers))
+                    writer.writerow([context, qa['question'].translate(table), start, end] + texts)
+
+
+def imap_ordered(func, items, num_workers=1, initializer=None, initargs=()):
+    # yields (item, func(item)) in input order; with workers, a bounded window of
+    # items is in flight at a time so a lazy input is never read ahead in full
+    if num_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield item, func(item)
+        return
+
+    # fork: initargs such as spaCy models are inherited instead of pickled
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(num_workers, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.apply_async(func, (item,))))
+            if len(pending) >= 2 * num_workers:
+                item, result = pending.popleft()
+                yield item, result.get()
+        while pending:
+            item, result = pending.popleft()
+            yield item, result.get()
+
+
+def iter_chunks(iterable, chunk_size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_filter_nlp = None
+
+
+def _init_filter_worker(nlp, pipe_batch_size):
+    global _filter_nlp
+    _filter_nlp = nlp, pipe_batch_size
+
+
+def _token_lengths(rows):
+    nlp, pipe_batch_size = _filter_nlp
+    texts = [row[0] for row in rows] + [row[1] for row in rows]
+    lengths = np.array([sum(not token.is_space for token in doc)
+                        for doc in nlp.pipe(texts, batch_size=pipe_batch_size)], dtype=np.int32)
+    return lengths.reshape(2, len(rows)).T
+
+
+def filter_dataset(filename, question_max_length=50, context_max_length=400,
+                   num_workers=1, chunk_size=1000, pipe_batch_size=256):
+    # streams the rows, keeps them in order and writes the [context, question] token
+    # lengths of the survivors to {filtered file}.lengths.npy
     import spacy
-    import csv
-    import os
-    from tqdm import tqdm
 
     spacy_en = spacy.load('en_core_web_sm',
                           disable=['vectors', 'textcat', 'tagger', 'parser', 'ner'])
 
-    def tokenizer(x): return [token for token in spacy_en(x) if not token.is_space]
-
-    with open(filename) as f:
-        dataset = [row for row in csv.reader(f, delimiter='\t')]
     basename, ext = os.path.splitext(filename)
-    filename = f'{basename}_filtered{ext}'
-    with open(filename, 'w') as f:
-        writer = csv.writer(f, delimiter='\t')
-        for data in tqdm(dataset):
-            context_tokens = tokenizer(data[0])
-            question_tokens = tokenizer(data[1])
-            if len(context_tokens) <= context_max_length and \
-               len(question_tokens) <= question_max_length:
-                writer.writerow(data)
-
-
-def make_small_dataset(filename, size=100, overwrite=False):
+    dest_filename = f'{basename}_filtered{ext}'
+    lengths = []
+    with open(filename) as f, open(dest_filename, 'w') as dest:
+        writer = csv.writer(dest, delimiter='\t')
+        chunks = iter_chunks(csv.reader(f, delimiter='\t'), chunk_size)
+        results = imap_ordered(_token_lengths, chunks, num_workers,
+                               _init_filter_worker, (spacy_en, pipe_batch_size))
+        for rows, chunk_lengths in tqdm(results):
+            keep = (chunk_lengths[:, 0] <= context_max_length) & \
+                (chunk_lengths[:, 1] <= question_max_length)
+            for row, kept in zip(rows, keep):
+                if kept:
+                    writer.writerow(row)
+            lengths.append(chunk_lengths[keep])
+    lengths = np.concatenate(lengths) if lengths else np.zeros((0, 2), dtype=np.int32)
+    np.save(f'{dest_filename}.lengths.npy', lengths)
+    return dest_filename
+
+
+def _copy_rows(filename, parts, dest_filenames):
+    # one sequential pass over the raw bytes: row i goes to dest_filenames[parts[i]],
+    # rows with a negative part are skipped; the .lengths.npy sidecar follows the rows
+    offsets = load_line_offsets(filename)
+    lengths_filename = f'{filename}.lengths.npy'
+    lengths = None
+    if os.path.exists(lengths_filename):
+        lengths = np.load(lengths_filename, mmap_mode='r')
+        if len(lengths) != len(offsets) - 1:
+            raise ValueError(f'{lengths_filename} has {len(lengths)} rows but {filename} has '
+                             f'{len(offsets) - 1} lines; remove it or run filter_dataset again')
+    with open(filename, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b''
+        dests = [open(dest_filename, 'wb') for dest_filename in dest_filenames]
+        try:
+            for i in tqdm(np.flatnonzero(parts >= 0)):
+                row = buffer[offsets[i]:offsets[i + 1]]
+                dest = dests[parts[i]]
+                dest.write(row)
+                if not row.endswith(b'\n'):
+                    dest.write(b'\n')
+        finally:
+            for dest in dests:
+                dest.close()
+
+    if lengths is not None:
+        for part, dest_filename in enumerate(dest_filenames):
+            np.save(f'{dest_filename}.lengths.npy', lengths[parts == part])
+
+
+def make_small_dataset(filename, size=100, overwrite=False, seed=None):
     basename, ext = os.path.splitext(filename)
     new_filename = f'{basename}_size_{size}{ext}'
 
     if os.path.exists(new_filename) and not overwrite:
         raise FileExistsError('Target file already exists, set overwrite as True')
 
-    with open(filename) as f:
-        num_lines = len(f.readlines())
-
-    indices = random.sample(range(num_lines), size)
-    with open(new_filename, 'w') as f:
-        writer = csv.writer(f, delimiter='\t')
-        for i in tqdm(indices):
-            line = linecache.getline(filename, i + 1)
-            data = next(csv.reader([line], delimiter='\t'))
-            writer.writerow(data)
-
-
-def split_dataset(filename, ratio=0.8, overwrite=False):
+    num_lines = len(load_line_offsets(filename)) - 1
+    indices = np.random.RandomState(seed).choice(num_lines, size, replace=False)
+    parts = np.full(num_lines, -1, dtype=np.int64)
+    parts[indices] = 0
+    _copy_rows(filename, parts, [new_filename])
+    return new_filename
+
+
+def split_dataset(filename, ratio=0.8, overwrite=False, seed=None, names=None):
+    # ratio: the train fraction of a train/dev split, or one fraction per part of a k-way split
+    ratios = [ratio, 1 - ratio] if np.isscalar(ratio) else list(ratio)
+    if names is None:
+        names = ['train', 'dev', 'test'][:len(ratios)] if len(ratios) <= 3 else \
+            [f'part{i}' for i in range(len(ratios))]
+    if len(names) != len(ratios):
+        raise ValueError('Give one name per split ratio')
     basename, ext = os.path.splitext(filename)
-    train_filename = f'{basename}_train{ext}'
-    dev_filename = f'{basename}_dev{ext}'
+    dest_filenames = [f'{basename}_{name}{ext}' for name in names]
 
-    if os.path.exists(train_filename) and not overwrite:
+    if any(os.path.exists(x) for x in dest_filenames) and not overwrite:
         raise FileExistsError('Target file already exists, set overwrite as True')
 
-    with open(filename) as f:
-        num_lines = len(f.readlines())
-
-    train_size = round(num_lines * ratio)
-    indices = list(range(num_lines))
-    random.shuffle(indices)
-
-    def write_csv(filename, index, writer):
-        line = linecache.getline(filename, index)
-        data = next(csv.reader([line], delimiter='\t'))
-        writer.writerow(data)
-
-    with open(train_filename, 'w') as f:
-        writer = csv.writer(f, delimiter='\t')
-        for i in tqdm(indices[:train_size]):
-            write_csv(filename, i + 1, writer)
-
-    with open(dev_filename, 'w') as f:
-        writer = csv.writer(f, delimiter='\t')
-        for i in tqdm(indices[train_size:]):
-            write_csv(filename, i + 1, writer)
+    num_lines = len(load_line_offsets(filename)) - 1
+    bounds = np.round(np.cumsum([0] + ratios) / sum(ratios) * num_lines).astype(np.int64)
+    order = np.random.RandomState(seed).permutation(num_lines)
+    parts = np.empty(num_lines, dtype=np.int64)
+    for part, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        parts[order[start:stop]] = part
+    _copy_rows(filename, parts, dest_filenames)
+    return dest_filenames
 
 
 def save_word_embedding_as_npy(filename, dim):
+    # vectors are parsed straight into a memory-mapped .npy and words are written
+    # one per line in row order, so the matrix is never held as Python floats
     npy_name = f'{filename}.npy'
-    dict_name = f'{filename}.dict'
-    embeddings = []
-    token_to_index = {}
+    words_name = f'{filename}.words'
     with open(filename) as f:
+        size = sum(1 for line in f if len(line.split()) > dim)
+    embeddings = np.lib.format.open_memmap(npy_name, mode='w+', dtype=np.float32, shape=(size, dim))
+    token_to_index = {}
+    with open(filename) as f, open(words_name, 'w', encoding='utf-8') as words:
+        index = 0
         for line in tqdm(f):
             elements = line.split()
-            word = ''.join(elements[0:-dim])
-            vector = [float(x) for x in elements[-dim:]]
-            if len(vector) != dim:
+            # a word and dim values, which also skips the fastText header
+            if len(elements) <= dim:
                 continue
-            embeddings.append(vector)
-            token_to_index[word] = len(token_to_index)
-    with open(dict_name, 'wb') as f:
-        pickle.dump(token_to_index, f)
-
-    embeddings = np.array(embeddings, dtype=np.float32)
-
-    np.save(npy_name, embeddings)
+            word = ''.join(elements[0:-dim])
+            embeddings[index] = elements[-dim:]
+            token_to_index[word] = index
+            words.write(f'{word}\n')
+            index += 1
+    embeddings.flush()
 
     return token_to_index, embeddings
 
 
-def extract_embeddings(vocab, big_vocab, big_embeddings, dim=300):
-    embeddings = np.zeros((len(vocab), 300), dtype=np.float32)
-    for word, index in vocab.items():
-        if word in big_vocab:
-            vector = big_embeddings[big_vocab[word]]
-            embeddings[index] = vector
+def load_word_index(filename, vocab=None):
+    # .words: one word per line in row order, .dict: the old pickled dict. Given a vocab,
+    # .words is streamed and only the rows of vocab words are kept, so the millions of
+    # other pretrained words never go into a dict
+    if filename.endswith('.dict'):
+        with open(filename, 'rb') as f:
+            token_to_index = pickle.load(f)
+        if vocab is None:
+            return token_to_index
+        return {word: token_to_index[word] for word in vocab if word in token_to_index}
+    with open(filename, encoding='utf-8') as f:
+        words = (line[:-1] for line in f)
+        if vocab is None:
+            return {word: index for index, word in enumerate(words)}
+        vocab = set(vocab)
+        return {word: index for index, word in enumerate(words) if word in vocab}
+
+
+def load_word_embedding(filename):
+    token_to_index = load_word_index(f'{filename}.words')
+    return token_to_index, np.load(f'{filename}.npy', mmap_mode='r')
+
+
+def extract_embeddings(vocab, big_vocab, big_embeddings, dim=None, oov_init='zeros', seed=None,
+                       pad_index=None, return_oov=False, special_indices=()):
+    if dim is None:
+        dim = big_embeddings.shape[1]
+    elif dim != big_embeddings.shape[1]:
+        raise ValueError(f'Expected {dim}-dim embeddings, got {big_embeddings.shape[1]}')
+    if oov_init not in ('zeros', 'normal', 'mean'):
+        raise ValueError(f'Unknown oov_init: {oov_init}')
+
+    embeddings = np.zeros((len(vocab), dim), dtype=np.float32)
+    found = np.zeros(len(vocab), dtype=np.bool_)
+    pairs = [(index, big_vocab[word]) for word, index in vocab.items() if word in big_vocab]
+    if pairs:
+        rows, big_rows = np.array(pairs, dtype=np.int64).T
+        # sorted rows turn the gather into a forward scan over a memory-mapped matrix
+        order = np.argsort(big_rows)
+        rows, big_rows = rows[order], big_rows[order]
+        embeddings[rows] = big_embeddings[big_rows]
+        found[rows] = True
+
+    oov = ~found
+    if oov.any() and found.any() and oov_init != 'zeros':
+        if oov_init == 'mean':
+            embeddings[oov] = embeddings[found].mean(axis=0)
+        else:
+            random_state = np.random.RandomState(seed)
+            scale = embeddings[found].std()
+            embeddings[oov] = random_state.normal(0, scale, (oov.sum(), dim))
+    if pad_index is not None:
+        # padding stays a zero vector whatever the OOV initialization
+        embeddings[pad_index] = 0
+
+    if return_oov:
+        # special tokens such as <pad> and <unk> are never in the pretrained vocabulary,
+        # so they are left out of the rate
+        words = np.ones(len(vocab), dtype=np.bool_)
+        words[list(special_indices)] = False
+        return embeddings, oov[words].mean() if words.any() else 0.
     return embeddings
 
 